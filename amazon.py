@@ -3,14 +3,85 @@ Contains functions for getting Amazon wish lists
 """
 
 from bs4 import BeautifulSoup
+import contextlib
 import datetime as dt
+import gzip
+import html
+from itemrecord import ItemRecord
+import metrics
 import pathlib
+import queue
 import re
-from seleniumwire import webdriver
+import requests
+import threading
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import urljoin
 
 WEBDRIVER_PATH = './chromedriver.exe'
+# lxml builds the soup several times faster than the standard library parser, use it when it is installed
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+# seconds allowed for a single list page to load before the fetch is abandoned
+LIST_TIMEOUT = 60
+# write the raw html of every fetched list to ~/bookshelf/debug, gzip compressed if DEBUG_DUMP_COMPRESS
+DEBUG_DUMP = False
+DEBUG_DUMP_COMPRESS = True
+# 'http' pages through a list with plain requests and falls back to 'selenium', which renders the list in Chrome
+FETCH_BACKENDS = ('http', 'selenium')
+FETCH_BACKEND = 'http'
+# most "show more" pages followed for one list over http
+HTTP_MAX_PAGES = 200
+# seconds between checks of the item count while scrolling a list
+SCROLL_POLL_INTERVAL = 0.1
+# seconds the item count has to stay the same before the list is considered fully loaded
+SCROLL_STABLE_FOR = 0.5
+# start browsers with the lean profile: no images, media, fonts or third-party requests, and almost nothing kept by
+# the seleniumwire proxy
+LEAN_BROWSER = True
+# Chrome switches and preferences of the lean profile
+LEAN_CHROME_ARGUMENTS = ('--blink-settings=imagesEnabled=false', '--mute-audio', '--disable-extensions',
+                         '--disable-background-networking')
+LEAN_CHROME_PREFS = {'profile.managed_default_content_settings.images': 2,
+                     'profile.default_content_setting_values.notifications': 2,
+                     'profile.managed_default_content_settings.media_stream': 2}
+# hosts of Amazon's stores and of the static content their pages load, anything else counts as third-party
+AMAZON_HOST_PATTERN = (r'([^/?#]*\.)?(amazon\.(com(\.[a-z]{2})?|co\.[a-z]{2}|[a-z]{2,3})|'
+                       r'media-amazon\.com|ssl-images-amazon\.com)')
+# urls the lean profile aborts in the proxy: images, fonts and media by extension, and anything not served by Amazon.
+# Only these are intercepted, everything else streams through the proxy without being stored.
+BLOCKED_URL_PATTERNS = [r'^[^?#]*\.(jpe?g|png|gif|webp|avif|svg|ico|bmp)([?#]|$)',
+                        r'^[^?#]*\.(woff2?|ttf|otf|eot)([?#]|$)',
+                        r'^[^?#]*\.(mp4|webm|m3u8|mp3|m4a|ogg|wav)([?#]|$)',
+                        r'^[a-z]+://(?!' + AMAZON_HOST_PATTERN + r'(:\d+)?([/?#]|$))']
+# most requests the seleniumwire proxy keeps in memory per browser, with the lean profile only aborted ones are kept
+REQUEST_STORAGE_MAX_SIZE = 100
+
+# scrolls to the bottom of the page and reports how many list items are loaded and whether the end of the list shows
+SCROLL_SCRIPT = """
+window.scrollTo(0, document.body.scrollHeight);
+return [document.querySelectorAll('div.a-fixed-left-grid-inner').length,
+        document.getElementById('endOfListMarker') !== null];
+"""
+# bytes the page and everything it loaded took over the network, from the resource timing API
+TRANSFER_SIZE_SCRIPT = """
+return performance.getEntries().reduce(
+    (total, entry) => total + Math.max(entry.transferSize || 0, entry.encodedBodySize || 0), 0);
+"""
+ITEM_NAME_ID_RE = re.compile('^itemName_(.*)')
+ITEM_BYLINE_ID_RE = re.compile('^item-byline-(.*)')
+# tokens of a list page for iter_item_fragments: comments and script and style elements, which are skipped whole,
+# div tags, and any other tag, so a '<div' in another tag's attribute value isn't taken for a div. Quoted attribute
+# values may hold '>'
+HTML_TOKEN_RE = re.compile(r'<!--.*?(?:-->|\Z)'
+                           r'|<(script|style)\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>.*?(?:</\1\s*>|\Z)'
+                           r'|<(/?)(?=[a-z])(div\b)?((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.IGNORECASE | re.DOTALL)
+ATTRIBUTE_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+SHOW_MORE_INPUT_RE = re.compile(r'<input[^>]*name="showMoreUrl"[^>]*>')
+INPUT_VALUE_RE = re.compile(r'value="([^"]*)"')
 
 
 class Error(Exception):
@@ -52,7 +123,7 @@ def parse_item_name(item: Any) -> Optional[str]:
     :param item: bs4.element.Tag
     :return: string
     """
-    for element in item.find_all('a', class_='a-link-normal', id=re.compile('^itemName_(.*)')):
+    for element in item.find_all('a', class_='a-link-normal', id=ITEM_NAME_ID_RE):
         if 'title' in element.attrs:
             return element['title']
     raise ItemNotFoundError('Item Name', 'Item name not found')
@@ -65,7 +136,7 @@ def parse_item_byline(item: Any) -> str:
     :return: string
     """
     try:
-        value = item.find_all('span', class_="a-size-base", id=re.compile('^item-byline-(.*)'))[0].contents[0]
+        value = item.find_all('span', class_="a-size-base", id=ITEM_BYLINE_ID_RE)[0].contents[0]
     except IndexError:
         value = 'N/A'
     return value
@@ -147,74 +218,524 @@ def parse_item_external_id(item: Any) -> str:
     return item_external_id
 
 
-def parse_html(html_source: str, name: str) -> Any:
-    # dump raw html to file for debug
-    path = pathlib.Path.home().joinpath('bookshelf', 'debug', name + '.html')
-    with path.open(mode='w', encoding="utf-8") as f:
-        f.write(html_source)
-    soup = BeautifulSoup(html_source, 'html.parser')
-    items = soup.find_all('div', class_='a-fixed-left-grid-inner', style='padding-left:220px')
-    return items
+def extract_item(item: Any) -> Dict[str, Any]:
+    """
+    Extract all fields of an item in a single walk over its html soup.
+    Gives the same values as calling each of the parse_* functions on the item, which each search the whole item.
+    :param item: bs4.element.Tag
+    :return: dict of name, by_line, price_amazon, price_used_new, rating, num_reviews, item_id, item_external_id
+    """
+    name = None
+    by_line = price_symbol = price_whole = price_fraction = price_used_new = stars = num_reviews = None
+    item_id = item_external_id = None
+    for tag in item.descendants:
+        tag_name = tag.name
+        if tag_name == 'span':
+            classes = tag.get('class') or ()
+            if by_line is None and 'a-size-base' in classes and ITEM_BYLINE_ID_RE.search(tag.get('id', '')):
+                by_line = tag
+            if price_symbol is None and 'a-price-symbol' in classes:
+                price_symbol = tag
+            if price_whole is None and 'a-price-whole' in classes:
+                price_whole = tag
+            if price_fraction is None and 'a-price-fraction' in classes:
+                price_fraction = tag
+            if stars is None and 'a-icon-alt' in classes:
+                stars = tag
+            if price_used_new is None and ' '.join(classes) == 'a-color-price itemUsedAndNewPrice':
+                price_used_new = tag
+        elif tag_name == 'a':
+            classes = tag.get('class') or ()
+            if 'a-link-normal' not in classes:
+                continue
+            if name is None and 'title' in tag.attrs and ITEM_NAME_ID_RE.search(tag.get('id', '')):
+                name = tag['title']
+            if num_reviews is None and ' '.join(classes) == 'a-size-base a-link-normal':
+                num_reviews = tag
+        elif tag_name == 'input':
+            input_name = tag.get('name')
+            if item_id is None and input_name == 'itemId':
+                item_id = tag
+            elif item_external_id is None and input_name == 'itemExternalId':
+                item_external_id = tag
+
+    if name is None:
+        raise ItemNotFoundError('Item Name', 'Item name not found')
+    # values are copied out as plain strings so they don't keep the item's soup alive
+    fields = {'name': name, 'by_line': 'N/A', 'price_amazon': r'N/A', 'price_used_new': r'N/A', 'rating': 'N/A',
+              'num_reviews': '0', 'item_id': '', 'item_external_id': ''}
+    try:
+        fields['by_line'] = str(by_line.contents[0])
+    except (AttributeError, IndexError):
+        pass
+    try:
+        fields['price_amazon'] = str(price_symbol.contents[0] + price_whole.contents[0] + '.' +
+                                     price_fraction.contents[0])
+    except (AttributeError, IndexError):
+        pass
+    try:
+        fields['price_used_new'] = str(price_used_new.contents[0])
+    except (AttributeError, IndexError):
+        pass
+    try:
+        stars_words = stars.contents[0].split()
+        fields['rating'] = (float(stars_words[0]), float(stars_words[3]))
+    except (AttributeError, IndexError):
+        pass
+    try:
+        fields['num_reviews'] = str(num_reviews.contents[0].strip())
+    except (AttributeError, IndexError):
+        pass
+    if item_id is not None:
+        fields['item_id'] = item_id['value']
+    if item_external_id is not None:
+        fields['item_external_id'] = item_external_id['value']
+    return fields
 
 
-def get_amazon_list(url: str, name: str = 'no name', webdriver_path: str = WEBDRIVER_PATH) -> Any:
+def find_items(html_source: str, parser: str = HTML_PARSER) -> Any:
     """
-    Use Selenium webdriver for Chrome in headless mode to retrieve the page for an Amazon Wish List.
-    The list expands dynamically as the use scrolls down the page if the list is long enough to go past one page.
-    After requesting the page, the webdriver scrolls to the bottom of the page as much as it can, and waits 5
-    seconds to allow time for the rest of the content to load. Then the html of the page, which now includes the
-    entire list is fetched from the webdriver.
-    :param url: url of Amazon wish list
-    :param name: the name of the Amazon list
-    :param webdriver_path: path to the websdriver executable
+    Parse a list page and find the html soup of each item on it.
+    :param html_source: html of the list page
+    :param parser: BeautifulSoup tree builder, e.g. 'lxml' or 'html.parser'
     :return: bs4.element.ResultSet
     """
+    soup = BeautifulSoup(html_source, parser)
+    return soup.find_all('div', class_='a-fixed-left-grid-inner', style='padding-left:220px')
+
+
+def is_item_div(attributes: str) -> bool:
+    """
+    Check the attributes of a div start tag against the ones find_items looks for.
+    :param attributes: text of the start tag after '<div'
+    :return: True if the div is a list item
+    """
+    values = {m.group(1).lower(): next(v for v in m.groups()[1:] if v is not None)
+              for m in ATTRIBUTE_RE.finditer(attributes)}
+    return 'a-fixed-left-grid-inner' in values.get('class', '').split() and \
+        values.get('style') == 'padding-left:220px'
+
+
+def iter_item_fragments(html_source: str) -> Iterator[str]:
+    """
+    Find the html of each list item by scanning the div tags of the page, without parsing the rest of the page.
+    Comments, scripts and styles are skipped, as a parser would, so a div tag inside them doesn't count.
+    :param html_source: html of the list page
+    :return: generator of the html of each item div
+    """
+    start = None
+    depth = 0
+    for match in HTML_TOKEN_RE.finditer(html_source):
+        if match.group(3) is None:
+            continue
+        closing, attributes = match.group(2), match.group(4)
+        if start is None:
+            if not closing and is_item_div(attributes):
+                start = match.start()
+                depth = 1
+            continue
+        if closing:
+            depth -= 1
+        elif not attributes.rstrip().endswith('/'):
+            depth += 1
+        if depth == 0:
+            yield html_source[start:match.end()]
+            start = None
+    if start is not None:
+        yield html_source[start:]
+
+
+def parse_fragment(fragment: str, parser: str = HTML_PARSER) -> Any:
+    """
+    Parse the html of one item div from iter_item_fragments.
+    :param fragment: html of the item div
+    :param parser: BeautifulSoup tree builder, e.g. 'lxml' or 'html.parser'
+    :return: bs4.element.Tag, or None if the fragment holds no item
+    """
+    return BeautifulSoup(fragment, parser).find('div', class_='a-fixed-left-grid-inner', style='padding-left:220px')
+
+
+def iter_items(html_source: str, parser: str = HTML_PARSER) -> Iterator[Any]:
+    """
+    Parse a list page one item at a time. Only a single item's soup is built at once, so the caller can extract it
+    and let it go before the next item is parsed.
+    :param html_source: html of the list page
+    :param parser: BeautifulSoup tree builder, e.g. 'lxml' or 'html.parser'
+    :return: generator of bs4.element.Tag
+    """
+    for fragment in iter_item_fragments(html_source):
+        item = parse_fragment(fragment, parser)
+        if item is not None:
+            yield item
+
+
+def dump_html(html_source: str, name: str, compress: bool = DEBUG_DUMP_COMPRESS) -> None:
+    """
+    Write the raw html of a list to ~/bookshelf/debug for debugging.
+    :param html_source: html of the list page
+    :param name: the name of the Amazon list, used as the file name
+    :param compress: gzip the file
+    """
+    path = pathlib.Path.home().joinpath('bookshelf', 'debug', name + ('.html.gz' if compress else '.html'))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if compress:
+        with gzip.open(path, mode='wt', encoding='utf-8') as f:
+            f.write(html_source)
+    else:
+        with path.open(mode='w', encoding='utf-8') as f:
+            f.write(html_source)
+
+
+def parse_html(html_source: str, name: str, stream: bool = True, dump: bool = DEBUG_DUMP) -> Any:
+    """
+    Find the items of a list page.
+    :param html_source: html of the list page
+    :param name: the name of the Amazon list
+    :param stream: parse one item at a time with iter_items instead of building the soup of the whole page
+    :param dump: write the raw html to ~/bookshelf/debug first
+    :return: generator of bs4.element.Tag if stream, otherwise bs4.element.ResultSet
+    """
+    if dump:
+        dump_html(html_source, name)
+    if stream:
+        return iter_items(html_source)
+    return find_items(html_source)
+
+
+def abort_request(request: Any) -> None:
+    """
+    seleniumwire request interceptor of the lean profile. It only sees requests matching BLOCKED_URL_PATTERNS.
+    :param request: seleniumwire request
+    """
+    request.abort()
+
+
+def make_browser(webdriver_path: str = WEBDRIVER_PATH, lean: bool = LEAN_BROWSER) -> Any:
+    """
+    Start a headless Chrome webdriver with the request headers from construct_headers().
+    With the lean profile Chrome doesn't load images, the proxy aborts fonts, media and requests to hosts other than
+    Amazon's, and the proxy keeps no bodies of the requests it lets through, since only the page's html is needed.
+    :param webdriver_path: path to the webdriver executable
+    :param lean: use the lean profile
+    :return: seleniumwire webdriver
+    """
+    # seleniumwire starts up slowly and is only needed when a list is rendered in Chrome
+    from seleniumwire import webdriver
+
     options = webdriver.ChromeOptions()
     options.add_argument('headless')
-    browser = webdriver.Chrome(executable_path=webdriver_path, chrome_options=options)
+    seleniumwire_options = {}
+    if lean:
+        for argument in LEAN_CHROME_ARGUMENTS:
+            options.add_argument(argument)
+        options.add_experimental_option('prefs', LEAN_CHROME_PREFS)
+        seleniumwire_options = {'request_storage': 'memory', 'request_storage_max_size': REQUEST_STORAGE_MAX_SIZE}
+    with metrics.span('browser_start'):
+        browser = webdriver.Chrome(executable_path=webdriver_path, chrome_options=options,
+                                   seleniumwire_options=seleniumwire_options)
     # browser.implicitly_wait(5)
     browser.header_overrides = construct_headers()
-    browser.get(url)
+    if lean:
+        # requests out of scope are neither intercepted nor stored
+        browser.scopes = BLOCKED_URL_PATTERNS
+        browser.request_interceptor = abort_request
+    return browser
 
-    # scroll to bottom of page to get it all to load
-    while True:
+
+class BrowserPool:
+    """
+    A bounded pool of long-lived headless browsers shared by concurrent list fetches.
+    Browsers are started lazily, so the pool never runs more than size browsers and never more than are needed.
+    A browser that raises during a fetch is quit and replaced on the next checkout instead of being reused.
+    """
+
+    def __init__(self, size: int = 1, webdriver_path: str = WEBDRIVER_PATH):
+        self.size = size
+        self.webdriver_path = webdriver_path
+        self._idle = queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._browsers = []
+
+    def __enter__(self) -> 'BrowserPool':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        self.close()
+
+    @contextlib.contextmanager
+    def browser(self) -> Iterator[Any]:
+        """
+        Check out a browser for the duration of the with block, waiting if all browsers are busy.
+        :return: seleniumwire webdriver
+        """
+        with self._slots:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                browser = make_browser(self.webdriver_path)
+                with self._lock:
+                    self._browsers.append(browser)
+            try:
+                yield browser
+            except Exception:
+                self._discard(browser)
+                raise
+            else:
+                self._idle.put(browser)
+
+    def _discard(self, browser: Any) -> None:
+        with self._lock:
+            if browser in self._browsers:
+                self._browsers.remove(browser)
         try:
-            # Action scroll down
-            browser.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+            browser.quit()
+        except Exception as e:
+            print(e, ' in BrowserPool._discard')
+
+    def close(self) -> None:
+        """
+        Quit every browser started by the pool.
+        """
+        with self._lock:
+            browsers, self._browsers = self._browsers, []
+        for browser in browsers:
+            try:
+                browser.quit()
+            except Exception as e:
+                print(e, ' in BrowserPool.close')
+
+
+def scroll_until_stable(browser: Any, poll_interval: float = SCROLL_POLL_INTERVAL,
+                        stable_for: float = SCROLL_STABLE_FOR, max_wait: float = LIST_TIMEOUT) -> int:
+    """
+    Keep scrolling to the bottom of a list page until the whole list is loaded.
+    The list counts as loaded once Amazon's end of list marker is on the page, or once the number of item nodes has
+    not changed for stable_for seconds. Gives up after max_wait seconds and keeps whatever has loaded by then.
+    :param browser: seleniumwire webdriver with the list page open
+    :param poll_interval: seconds between checks
+    :param stable_for: seconds the item count must stay unchanged
+    :param max_wait: seconds before giving up
+    :return: number of item nodes on the page
+    """
+    start = time.monotonic()
+    stable_since = start
+    last_count = -1
+    while True:
+        count, at_end = browser.execute_script(SCROLL_SCRIPT)
+        now = time.monotonic()
+        if at_end:
             break
-        except Error:
-            pass
-
-    time.sleep(5)
-    html_source: str = browser.page_source
-    browser.quit()
-    items = parse_html(html_source, name)
-    return items
-
-
-def build_items_list(items: Any, list_name: str = '') -> List[Dict[str, str]]:
-    print('Extracting ' + str(len(items)) + ' items')
-    names = [parse_item_name(i) for i in items]
-    by_lines = [parse_item_byline(i) for i in items]
-    prices_amazon = [parse_item_amazon_price(i) for i in items]
-    prices_used_new = [parse_item_used_new_price(i) for i in items]
-    ratings = [parse_rating(i) for i in items]
-    num_reviews = [parse_num_reviews(i) for i in items]
-    item_ids = [parse_item_id(i) for i in items]
-    item_external_ids = [parse_item_external_id(i) for i in items]
-    update_time = str(dt.datetime.now())
-    combos = zip(names, by_lines, prices_amazon, prices_used_new, ratings, num_reviews, item_ids, item_external_ids)
-    list_dict = [{'name': i[0],
-                  'by_line': i[1],
-                  'price_amazon': i[2],
-                  'price_used_new': i[3],
-                  'rating': i[4][0],
-                  'num_reviews': i[5],
-                  'item_id': i[6],
-                  'item_external_id': i[7],
-                  'update_date': update_time,
-                  'list_name': list_name} for i in combos]
-    return list_dict
+        if count != last_count:
+            last_count = count
+            stable_since = now
+        elif now - stable_since >= stable_for:
+            break
+        if now - start >= max_wait:
+            print('List still loading after', max_wait, 'seconds, keeping', count, 'items')
+            break
+        time.sleep(poll_interval)
+    return count
+
+
+def fetch_list_html(browser: Any, url: str, timeout: float = LIST_TIMEOUT, name: str = 'no name') -> str:
+    """
+    Load an Amazon Wish List page in an already running browser and return its html.
+    The list expands dynamically as the user scrolls down the page if the list is long enough to go past one page,
+    so the page is scrolled until no more items load (see scroll_until_stable) before the html is read.
+    :param browser: seleniumwire webdriver
+    :param url: url of Amazon wish list
+    :param timeout: seconds allowed for the page load, and separately for scrolling the list in
+    :param name: the name of the Amazon list, for reporting the bytes transferred
+    :return: html source of the page
+    """
+    browser.set_page_load_timeout(timeout)
+    browser.set_script_timeout(timeout)
+    with metrics.span('page_load', backend='selenium'):
+        browser.get(url)
+    with metrics.span('scroll_wait'):
+        scroll_until_stable(browser, max_wait=timeout)
+    html_source = browser.page_source
+    transferred = browser.execute_script(TRANSFER_SIZE_SCRIPT) or 0
+    print('Transferred', transferred // 1024, 'KiB for list', name)
+    metrics.count('bytes_transferred', transferred, list=name, backend='selenium')
+    # drop what the proxy kept of this page before the browser goes back to the pool
+    del browser.requests
+    return html_source
+
+
+def make_http_session(pool_size: int = 1) -> requests.Session:
+    """
+    Create a keep-alive http session for fetching list pages, with the headers and cookie from construct_headers().
+    :param pool_size: number of connections kept open per host, one per concurrent fetch
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(construct_headers())
+    return session
+
+
+def parse_show_more_url(html_source: str) -> Optional[str]:
+    """
+    Find the url of the next page of a list, which Amazon puts in the hidden showMoreUrl input of each page.
+    :param html_source: html of a list page
+    :return: url of the next page, relative to the page, or None on the last page
+    """
+    tag = SHOW_MORE_INPUT_RE.search(html_source)
+    if tag is None:
+        return None
+    value = INPUT_VALUE_RE.search(tag.group(0))
+    if value is None or value.group(1) == '':
+        return None
+    return html.unescape(value.group(1))
+
+
+def fetch_list_html_http(session: requests.Session, url: str, timeout: float = LIST_TIMEOUT,
+                         max_pages: int = HTTP_MAX_PAGES, name: str = 'no name') -> str:
+    """
+    Fetch every page of an Amazon Wish List over http, following the showMoreUrl pagination from page to page.
+    :param session: http session from make_http_session
+    :param url: url of Amazon wish list
+    :param timeout: seconds allowed for each page request
+    :param max_pages: most pages to follow
+    :param name: the name of the Amazon list, for reporting the bytes transferred
+    :return: html of all pages joined together
+    """
+    pages = []
+    seen = set()
+    next_url = url
+    while next_url is not None and next_url not in seen and len(pages) < max_pages:
+        seen.add(next_url)
+        with metrics.span('page_load', backend='http'):
+            response = session.get(next_url, timeout=timeout)
+            response.raise_for_status()
+        metrics.count('http_pages')
+        metrics.count('bytes_transferred', len(response.content), list=name, backend='http')
+        pages.append(response.text)
+        show_more_url = parse_show_more_url(response.text)
+        next_url = urljoin(response.url, show_more_url) if show_more_url is not None else None
+    return '\n'.join(pages)
+
+
+def try_list_html_http(session: requests.Session, url: str, timeout: float = LIST_TIMEOUT,
+                       name: str = 'no name') -> Optional[str]:
+    """
+    Fetch a list over http, deciding whether the selenium backend has to fetch it instead: when the request fails or
+    no items were found, for example because Amazon answered with a robot check.
+    :param session: http session from make_http_session
+    :param url: url of Amazon wish list
+    :param timeout: seconds allowed for each page request
+    :param name: the name of the Amazon list
+    :return: html of all pages joined together, None if the list should be fetched with selenium
+    """
+    try:
+        html_source = fetch_list_html_http(session, url, timeout, name=name)
+    except requests.RequestException as e:
+        print(e, ' in try_list_html_http - falling back to selenium')
+        return None
+    if next(iter_item_fragments(html_source), None) is None:
+        print('No items found over http for list', name, '- falling back to selenium')
+        return None
+    return html_source
+
+
+def fetch_list_html_selenium(url: str, webdriver_path: str = WEBDRIVER_PATH, pool: Optional[BrowserPool] = None,
+                             timeout: float = LIST_TIMEOUT, name: str = 'no name') -> str:
+    """
+    Fetch the html of an Amazon Wish List with Selenium webdriver for Chrome in headless mode.
+    If a BrowserPool is given the page is loaded in one of its browsers, otherwise a browser is started for this
+    list alone and quit afterwards.
+    :param url: url of Amazon wish list
+    :param webdriver_path: path to the websdriver executable
+    :param pool: optional pool of running browsers to fetch with
+    :param timeout: seconds allowed for the page load
+    :param name: the name of the Amazon list
+    :return: html source of the page
+    """
+    if pool is not None:
+        with pool.browser() as browser:
+            return fetch_list_html(browser, url, timeout, name)
+    browser = make_browser(webdriver_path)
+    try:
+        return fetch_list_html(browser, url, timeout, name)
+    finally:
+        browser.quit()
+
+
+def get_list_html(url: str, name: str = 'no name', webdriver_path: str = WEBDRIVER_PATH,
+                  pool: Optional[BrowserPool] = None, timeout: float = LIST_TIMEOUT,
+                  backend: str = FETCH_BACKEND, session: Optional[requests.Session] = None,
+                  dump: bool = DEBUG_DUMP) -> str:
+    """
+    Retrieve the html of an Amazon Wish List.
+    With the http backend the list is paged through over plain http. If that fails or finds no items, for example
+    because Amazon answered with a robot check, the list is fetched again with the selenium backend.
+    :param url: url of Amazon wish list
+    :param name: the name of the Amazon list
+    :param webdriver_path: path to the websdriver executable
+    :param pool: optional pool of running browsers for the selenium backend
+    :param timeout: seconds allowed for the page load
+    :param backend: one of FETCH_BACKENDS
+    :param session: optional http session for the http backend
+    :param dump: write the raw html to ~/bookshelf/debug
+    :return: html of the list
+    """
+    if backend not in FETCH_BACKENDS:
+        raise ValueError('Unknown fetch backend: ' + backend)
+    html_source = None
+    if backend == 'http':
+        if session is not None:
+            html_source = try_list_html_http(session, url, timeout, name)
+        else:
+            with make_http_session() as own_session:
+                html_source = try_list_html_http(own_session, url, timeout, name)
+        if html_source is None:
+            metrics.count('retries', list=name)
+    if html_source is None:
+        html_source = fetch_list_html_selenium(url, webdriver_path, pool, timeout, name)
+    if dump:
+        dump_html(html_source, name)
+    return html_source
+
+
+def get_amazon_list(url: str, name: str = 'no name', webdriver_path: str = WEBDRIVER_PATH,
+                    pool: Optional[BrowserPool] = None, timeout: float = LIST_TIMEOUT,
+                    backend: str = FETCH_BACKEND, session: Optional[requests.Session] = None) -> Any:
+    """
+    Retrieve and parse the items of an Amazon Wish List, see get_list_html.
+    :param url: url of Amazon wish list
+    :param name: the name of the Amazon list
+    :param webdriver_path: path to the websdriver executable
+    :param pool: optional pool of running browsers for the selenium backend
+    :param timeout: seconds allowed for the page load
+    :param backend: one of FETCH_BACKENDS
+    :param session: optional http session for the http backend
+    :return: generator of bs4.element.Tag
+    """
+    html_source = get_list_html(url, name, webdriver_path, pool, timeout, backend, session)
+    return parse_html(html_source, name, dump=False)
+
+
+def build_items_list(items: Any, list_name: str = '', update_date: Optional[str] = None) -> List[ItemRecord]:
+    """
+    Extract the fields of each item. Items can be a generator from parse_html, in which case each item's soup is
+    released as soon as it has been extracted. An item without an itemExternalId gets its itemrecord.item_identity.
+    :param items: iterable of bs4.element.Tag
+    :param list_name: the name of the Amazon list
+    :param update_date: date of the pull, now if None
+    :return: list of ItemRecord
+    """
+    update_time = str(dt.datetime.now()) if update_date is None else update_date
+    records = []
+    for i in items:
+        fields = extract_item(i)
+        fields['rating'] = fields['rating'][0]
+        records.append(ItemRecord(update_date=update_time, list_name=list_name, **fields).with_identity())
+    print('Extracted ' + str(len(records)) + ' items')
+    return records
 
 
 if __name__ == '__main__':
@@ -1,6 +1,17 @@
 
-from typing import List, Optional
-import matplotlib.pyplot as plt
+import datetime as dt
+import db
+from typing import Any, Dict, List, Optional
+import numpy as np
+# matplotlib.pyplot is imported in the plot functions, it takes most of a second to load and few sessions draw a chart
+
+# days covered by the moving average prices are compared against
+DEAL_WINDOW_DAYS = 30
+# fraction below the moving average a price has to be to count as a drop
+DEAL_DROP_THRESHOLD = 0.1
+# julian day number of the unix epoch, for converting timestamps to the julian days sqlite returns
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+UNIX_EPOCH = dt.datetime(1970, 1, 1)
 
 
 def ensure_int(num):
@@ -18,23 +29,146 @@ def convert_price_string(price_str: str) -> Optional[float]:
         return None
 
 
-def plot_price_histogram(raw_data: List[str]):
-    data = [convert_price_string(x) for x in raw_data if convert_price_string(x) is not None]
-    plt.hist(data)
+def to_float_array(raw_data: Any, strip: str = '$,') -> np.ndarray:
+    """
+    Convert a column of values to floats in one vectorized pass. Numbers pass through, strings as scraped, such as
+    '$12.34' or '1,234', have the characters in strip removed, and anything that isn't a number becomes nan.
+    :param raw_data: sequence or array of numbers, strings or None
+    :param strip: characters removed from strings before converting
+    :return: float array, nan where there is no valid value
+    """
+    values = np.asarray(raw_data)
+    if values.dtype.kind in 'fiub':
+        return values.astype(float)
+    values = values.astype(str)
+    for c in strip:
+        values = np.char.replace(values, c, '')
+    values = np.char.strip(values)
+    valid = np.char.isdigit(np.char.replace(values, '.', '', count=1))
+    result = np.full(values.shape, np.nan)
+    result[valid] = values[valid].astype(float)
+    return result
+
+
+def load_chart_columns() -> Dict[str, np.ndarray]:
+    """
+    Load the columns the charts plot, once per item, straight from the database. The arrays are kept in the
+    session's query cache until the database changes, so opening a chart again doesn't query or convert anything.
+    :return: dict of float arrays price (in currency units), rating and num_reviews, nan where there is no value
+    """
+    def query():
+        # None becomes nan when converting to float
+        values = np.array(db.get_chart_columns().fetchall(), dtype=float).reshape(-1, 3)
+        return {'price': values[:, 0] / 100, 'rating': values[:, 1], 'num_reviews': values[:, 2]}
+
+    return db.get_session().cached(('chart_columns',), query, rows=lambda columns: len(columns['price']))
+
+
+def plot_price_histogram(raw_data: Any):
+    import matplotlib.pyplot as plt
+
+    data = to_float_array(raw_data)
+    plt.hist(data[~np.isnan(data)])
     plt.show(block=False)
 
 
-def plot_ratings_reviews(raw_data: List[List]):
+def plot_ratings_reviews(ratings: Any, num_reviews: Any):
+    import matplotlib.pyplot as plt
+
+    ratings = to_float_array(ratings)
+    num_reviews = to_float_array(num_reviews)
+    valid = ~(np.isnan(ratings) | np.isnan(num_reviews))
+    plt.scatter(ratings[valid], num_reviews[valid])
+    plt.show(block=False)
+
+
+def load_price_history() -> Dict[str, np.ndarray]:
+    """
+    Load the Amazon price history of every item from the database in one query. The arrays are kept in the session's
+    query cache until the database changes.
+    :return: dict of arrays item_external_id, day (julian day number) and price (minor units), sorted by item and day
+    """
+    def query():
+        rows = db.get_price_history().fetchall()
+        if len(rows) == 0:
+            return {'item_external_id': np.array([], dtype=object), 'day': np.array([], dtype=float),
+                    'price': np.array([], dtype=float)}
+        item_external_ids, days, prices = zip(*rows)
+        return {'item_external_id': np.array(item_external_ids, dtype=object),
+                'day': np.array(days, dtype=float),
+                'price': np.array(prices, dtype=float)}
+
+    return db.get_session().cached(('price_history',), query, rows=lambda history: len(history['price']))
+
+
+def price_stats(history: Dict[str, np.ndarray], now: Optional[float] = None, window_days: float = DEAL_WINDOW_DAYS,
+                drop_threshold: float = DEAL_DROP_THRESHOLD) -> Dict[str, np.ndarray]:
+    """
+    Compute price statistics of all items at once from their price history.
+    Records are only written when a price changes, so each price holds from its record until the item's next record,
+    or until now for the latest one. The moving average weights each price by how long it held within the window.
+    :param history: arrays from load_price_history, sorted by item and day
+    :param now: julian day number to compute the stats at, the current time if None
+    :param window_days: days covered by the moving average
+    :param drop_threshold: fraction below the moving average that counts as a drop
+    :return: dict of arrays with one entry per item: item_external_id, current, all_time_low, moving_average,
+    pct_drop (fraction below the moving average) and is_drop
+    """
+    if now is None:
+        # update dates are stored in naive local time and julianday() reads them as if they were UTC, so now is
+        # taken the same way rather than from the real UTC timestamp
+        now = (dt.datetime.now() - UNIX_EPOCH).total_seconds() / 86400 + UNIX_EPOCH_JULIAN_DAY
+    ids, days, prices = history['item_external_id'], history['day'], history['price']
+    n = len(ids)
+    if n == 0:
+        empty = np.array([], dtype=float)
+        return {'item_external_id': ids, 'current': empty, 'all_time_low': empty, 'moving_average': empty,
+                'pct_drop': empty, 'is_drop': np.array([], dtype=bool)}
+
+    new_item = np.empty(n, dtype=bool)
+    new_item[0] = True
+    new_item[1:] = ids[1:] != ids[:-1]
+    starts = np.flatnonzero(new_item)
+    ends = np.append(starts[1:], n) - 1
+    item_index = np.cumsum(new_item) - 1
+
+    current = prices[ends]
+    all_time_low = np.minimum.reduceat(prices, starts)
+
+    held_until = np.empty(n, dtype=float)
+    held_until[:-1] = days[1:]
+    held_until[ends] = now
+    window_start = now - window_days
+    held = np.clip(held_until, window_start, now) - np.clip(days, window_start, now)
+    weighted = np.bincount(item_index, weights=held * prices, minlength=len(starts))
+    total = np.bincount(item_index, weights=held, minlength=len(starts))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moving_average = np.where(total > 0, weighted / total, current)
+        pct_drop = np.where(moving_average > 0, (moving_average - current) / moving_average, 0.0)
+    return {'item_external_id': ids[starts], 'current': current, 'all_time_low': all_time_low,
+            'moving_average': moving_average, 'pct_drop': pct_drop, 'is_drop': pct_drop >= drop_threshold}
 
-    def clean_row(row):
-        try:
-            row[1] = ensure_int(row[1])
-            row[0] = float(row[0])
-            return row
-        except ValueError:
-            return None
 
-    data = [clean_row(d) for d in raw_data if clean_row(d) is not None]
-    data = list(zip(*data))
-    plt.scatter(data[0], data[1])
-    plt.show(block=False)
\ No newline at end of file
+def best_deals(limit: int = 50, window_days: float = DEAL_WINDOW_DAYS,
+               drop_threshold: float = DEAL_DROP_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Rank the current items whose price has dropped below their moving average, biggest drop first.
+    :param limit: most items to return
+    :param window_days: days covered by the moving average
+    :param drop_threshold: fraction below the moving average that counts as a drop
+    :return: list of dicts of item details with moving_average, all_time_low (minor units) and pct_drop added
+    """
+    stats = price_stats(load_price_history(), window_days=window_days, drop_threshold=drop_threshold)
+    drops = np.flatnonzero(stats['is_drop'])
+    drops = drops[np.argsort(-stats['pct_drop'][drops], kind='stable')]
+    ranked = {stats['item_external_id'][i]: i for i in drops}
+    deals = {}
+    for item in db.get_current_items():
+        i = ranked.get(item.item_external_id)
+        # items on several lists are shown once, items without a price now are no deal
+        if i is None or item.item_external_id in deals or item.price_amazon_minor is None:
+            continue
+        deals[item.item_external_id] = dict(item._asdict(), moving_average=float(stats['moving_average'][i]),
+                                            all_time_low=float(stats['all_time_low'][i]),
+                                            pct_drop=float(stats['pct_drop'][i]))
+    return sorted(deals.values(), key=lambda d: -d['pct_drop'])[:limit]
@@ -0,0 +1,521 @@
+"""
+Benchmarks for parsing Amazon Wish List pages and for starting the GUI.
+
+Run against recorded list pages, for example the html dumps in ~/bookshelf/debug:
+    python benchmark.py ~/bookshelf/debug/*.html
+Time the start of the GUI against the database in ~/bookshelf:
+    python benchmark.py --startup
+Run the synthetic catalog suite, which needs no network or recorded pages, and compare with an earlier run:
+    python benchmark.py --catalog --scales 100 1000 10000 --compare ~/bookshelf/benchmarks/catalog-old.json
+Check the http fetch backend against synthetic pages served on localhost, exiting with 1 if it goes wrong:
+    python benchmark.py --http
+"""
+
+import amazon
+import argparse
+import datetime as dt
+import contextlib
+import html
+import http.server
+from itemrecord import ItemRecord
+import json
+import pathlib
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# seconds from starting python to the main window being shown, above which --startup reports a regression
+STARTUP_BUDGET = 1.0
+# modules whose import time --startup reports
+STARTUP_MODULES = ('main', 'PySimpleGUI', 'db', 'tablemodel', 'listutils', 'amazon', 'analyze', 'matplotlib.pyplot',
+                   'numpy', 'bs4', 'requests', 'seleniumwire.webdriver')
+# catalog sizes run by --catalog unless --scales is given
+SCALES = (100, 1000, 10000, 100000, 1000000)
+# items per synthetic list, a catalog is split over as many lists as it takes
+CATALOG_LIST_SIZE = 1000
+# pulls in a synthetic price history, one day apart and ending today
+HISTORY_PULLS = 5
+# fraction of items whose price changes from one synthetic pull to the next
+HISTORY_CHANGE_RATE = 0.1
+CATALOG_RESULTS_DIR = pathlib.Path.home().joinpath('bookshelf', 'benchmarks')
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+# run in a fresh interpreter by bench_startup, prints the seconds to the first page of the table and to the window
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import json, sys
+import db, main, tablemodel
+db.open_session(sys.argv[1])
+model = tablemodel.TableModel()
+model.reload()
+model.page_rows()
+first_page = time.perf_counter() - start
+try:
+    window = main.make_window(model).finalize()
+    first_window = time.perf_counter() - start
+    window.close()
+except Exception as e:
+    first_window = None
+    print(e, file=sys.stderr)
+print(json.dumps([first_page, first_window]))
+"""
+
+
+def build_items_list_per_field(items: Any, list_name: str = '') -> List[Dict[str, str]]:
+    """
+    The original build_items_list, which sweeps every item once per parse_* function. Kept as the baseline.
+    """
+    names = [amazon.parse_item_name(i) for i in items]
+    by_lines = [amazon.parse_item_byline(i) for i in items]
+    prices_amazon = [amazon.parse_item_amazon_price(i) for i in items]
+    prices_used_new = [amazon.parse_item_used_new_price(i) for i in items]
+    ratings = [amazon.parse_rating(i) for i in items]
+    num_reviews = [amazon.parse_num_reviews(i) for i in items]
+    item_ids = [amazon.parse_item_id(i) for i in items]
+    item_external_ids = [amazon.parse_item_external_id(i) for i in items]
+    update_time = str(dt.datetime.now())
+    combos = zip(names, by_lines, prices_amazon, prices_used_new, ratings, num_reviews, item_ids, item_external_ids)
+    return [{'name': i[0],
+             'by_line': i[1],
+             'price_amazon': i[2],
+             'price_used_new': i[3],
+             'rating': i[4][0],
+             'num_reviews': i[5],
+             'item_id': i[6],
+             'item_external_id': i[7],
+             'update_date': update_time,
+             'list_name': list_name} for i in combos]
+
+
+def best_time(func: Callable, repeat: int) -> Tuple[float, Any]:
+    """
+    Run func repeat times.
+    :return: fastest run in seconds and the result of the last run
+    """
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory(func: Callable) -> int:
+    """
+    Run func once under tracemalloc.
+    :return: peak bytes allocated while it ran
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def without_update_date(items: List[Any]) -> List[Dict[str, str]]:
+    return [{k: v for k, v in (d if isinstance(d, dict) else d._asdict()).items() if k != 'update_date'} for d in items]
+
+
+def bench_parse(html_source: str, repeat: int = 5) -> Dict[str, float]:
+    """
+    Time the original parse (html.parser and eight find_all sweeps per item) against the current one
+    (amazon.HTML_PARSER and a single extract_item walk per item) and the streaming parse (amazon.iter_items),
+    and check that all of them give the same items.
+    :param html_source: html of a list page
+    :param repeat: number of runs, the fastest is kept
+    :return: dict of timings in seconds
+    """
+    before_soup, before_tags = best_time(lambda: amazon.find_items(html_source, 'html.parser'), repeat)
+    before_extract, before_items = best_time(lambda: build_items_list_per_field(before_tags), repeat)
+    after_soup, after_tags = best_time(lambda: amazon.find_items(html_source, amazon.HTML_PARSER), repeat)
+    after_extract, after_items = best_time(lambda: amazon.build_items_list(after_tags), repeat)
+    stream, stream_items = best_time(lambda: amazon.build_items_list(amazon.iter_items(html_source)), repeat)
+    if without_update_date(before_items) != without_update_date(after_items):
+        raise AssertionError('Single pass extraction does not match the per-field parse')
+    if without_update_date(before_items) != without_update_date(stream_items):
+        raise AssertionError('Streaming parse does not match the per-field parse')
+    return {'items': len(after_items),
+            'before_soup': before_soup, 'before_extract': before_extract,
+            'after_soup': after_soup, 'after_extract': after_extract, 'stream': stream,
+            'tree_peak_bytes': peak_memory(lambda: amazon.build_items_list(amazon.find_items(html_source))),
+            'stream_peak_bytes': peak_memory(lambda: amazon.build_items_list(amazon.iter_items(html_source)))}
+
+
+def print_parse_result(name: str, result: Dict[str, float]) -> None:
+    before = result['before_soup'] + result['before_extract']
+    after = result['after_soup'] + result['after_extract']
+    print(f"{name}: {result['items']} items")
+    print(f"  before  soup {result['before_soup'] * 1000:9.1f} ms  extract {result['before_extract'] * 1000:9.1f} ms"
+          f"  total {before * 1000:9.1f} ms")
+    print(f"  after   soup {result['after_soup'] * 1000:9.1f} ms  extract {result['after_extract'] * 1000:9.1f} ms"
+          f"  total {after * 1000:9.1f} ms  ({before / after:.1f}x, parser {amazon.HTML_PARSER})")
+    print(f"  stream                                      total {result['stream'] * 1000:9.1f} ms")
+    print(f"  peak memory  whole page {result['tree_peak_bytes'] / 2 ** 20:.1f} MiB"
+          f"  streaming {result['stream_peak_bytes'] / 2 ** 20:.1f} MiB")
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    Import a module in a fresh interpreter with -X importtime.
+    :param module: module to import
+    :return: dict of cumulative import time in microseconds by module, for every module the import loaded
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match is not None:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def bench_startup(db_file: Optional[str] = None, repeat: int = 5) -> Dict[str, Any]:
+    """
+    Time starting the GUI in fresh interpreters: the import time of the modules in STARTUP_MODULES, and the time to
+    the first page of the table and to the main window being shown, counted from the start of the interpreter.
+    :param db_file: database to open, db.db_path if None
+    :param repeat: number of starts, the fastest is kept
+    :return: dict of timings in seconds, first_window is None if no window could be shown (e.g. without a display)
+    """
+    import db
+
+    db_file = str(db.db_path if db_file is None else pathlib.Path(db_file).expanduser())
+    times = import_times('main')
+    result = {'imports': {m: times[m] / 1e6 for m in STARTUP_MODULES if m in times},
+              'first_page': float('inf'), 'first_window': None}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, db_file], capture_output=True, text=True,
+                             check=True)
+        interpreter = time.perf_counter() - start
+        first_page, first_window = json.loads(run.stdout.splitlines()[-1])
+        # the script can only time itself once python is running, add the interpreter start measured from here
+        interpreter -= first_page if first_window is None else first_window
+        result['first_page'] = min(result['first_page'], interpreter + first_page)
+        if first_window is not None:
+            first_window += interpreter
+            result['first_window'] = first_window if result['first_window'] is None \
+                else min(result['first_window'], first_window)
+    return result
+
+
+def print_startup_result(result: Dict[str, Any]) -> bool:
+    """
+    :return: True if the start was within STARTUP_BUDGET
+    """
+    print('import time (cumulative)')
+    for module, seconds in result['imports'].items():
+        print(f"  {module:24} {seconds * 1000:9.1f} ms")
+    print(f"first page  {result['first_page'] * 1000:9.1f} ms")
+    if result['first_window'] is None:
+        print('first window not shown, no display?')
+    else:
+        print(f"first window {result['first_window'] * 1000:8.1f} ms")
+    elapsed = result['first_page'] if result['first_window'] is None else result['first_window']
+    if elapsed > STARTUP_BUDGET:
+        print(f'startup regression: over the {STARTUP_BUDGET:.1f} s budget')
+        return False
+    return True
+
+
+def make_item_html(i: int, rng: random.Random) -> str:
+    """
+    Html of one wish list item in the markup the parse_* functions expect. Like real lists, some items have no
+    Amazon price, no used & new price, or no rating and reviews.
+    :param i: item number, used for the ids, title and author
+    :param rng: random source
+    :return: html of the item div
+    """
+    price = ''
+    if rng.random() > 0.1:
+        price = ('<span class="a-price"><span class="a-offscreen">${0}.{1:02d}</span><span aria-hidden="true">'
+                 '<span class="a-price-symbol">$</span><span class="a-price-whole">{0}<span class="a-price-decimal">'
+                 '.</span></span><span class="a-price-fraction">{1:02d}</span></span></span>').format(
+            rng.randint(1, 120), rng.randint(0, 99))
+    used_new = ''
+    if rng.random() > 0.3:
+        used_new = '<span class="a-color-price itemUsedAndNewPrice">${}.{:02d}</span>'.format(
+            rng.randint(1, 80), rng.randint(0, 99))
+    rating = ''
+    if rng.random() > 0.2:
+        rating = ('<i class="a-icon a-icon-star-small"><span class="a-icon-alt">{:.1f} out of 5 stars</span></i>'
+                  '<a class="a-size-base a-link-normal" href="/product-reviews/B{:09d}"> {:,} </a>').format(
+            rng.randint(10, 50) / 10, i, rng.randint(1, 50000))
+    title = html.escape('Synthetic Book {} & Volume {}: {}'.format(i, rng.randint(1, 9), rng.choice(
+        ['Algorithms', 'Gardening', 'History', 'Poetry', 'Cooking', 'Physics', 'Travel'])))
+    return ('<div id="itemMain_I{0}"><div class="a-fixed-left-grid-inner" style="padding-left:220px">'
+            '<div class="a-fixed-left-grid-col a-col-left"><a class="a-link-normal" href="/dp/B{0:09d}">'
+            '<img src="https://images.example/{0}.jpg"></a></div>'
+            '<div class="a-fixed-left-grid-col a-col-right"><h3 class="a-size-base">'
+            '<a class="a-link-normal" id="itemName_I{0}" title="{1}" href="/dp/B{0:09d}">{1}</a></h3>'
+            '<span class="a-size-base" id="item-byline-I{0}">by Author {2} (Paperback)</span>{3}{4}{5}'
+            '<input type="hidden" name="itemId" value="I{0}">'
+            '<input type="hidden" name="itemExternalId" value="B{0:09d}"></div></div></div>').format(
+        i, title, i % 997, price, used_new, rating)
+
+
+def make_list_html(start: int, count: int, seed: int = 0, show_more_url: Optional[str] = None) -> str:
+    """
+    Html of a synthetic wish list page holding items start to start + count.
+    :param start: number of the first item
+    :param count: number of items
+    :param seed: seed of the random prices and ratings, the same seed gives the same page
+    :param show_more_url: url of the next page, as Amazon puts it in the showMoreUrl input, None on the last page
+    :return: html of the page
+    """
+    rng = random.Random(seed * 1000003 + start)
+    items = ''.join(make_item_html(i, rng) for i in range(start, start + count))
+    if show_more_url is None:
+        end = '<div id="endOfListMarker"></div>'
+    else:
+        end = '<input type="hidden" name="showMoreUrl" value="' + html.escape(show_more_url) + '">'
+    return ('<html><head><title>Wish List</title></head><body><div id="g-items">' + items + '</div>' + end +
+            '</body></html>')
+
+
+def iter_catalog_lists(scale: int, seed: int = 0) -> Any:
+    """
+    Split a synthetic catalog of scale items over lists of CATALOG_LIST_SIZE items.
+    :return: generator of tuples of list name and list html
+    """
+    for start in range(0, scale, CATALOG_LIST_SIZE):
+        yield 'Synthetic ' + str(start // CATALOG_LIST_SIZE), \
+            make_list_html(start, min(CATALOG_LIST_SIZE, scale - start), seed)
+
+
+def next_pull(items: List[ItemRecord], update_date: str, rng: random.Random) -> List[ItemRecord]:
+    """
+    A later pull of the same list, with HISTORY_CHANGE_RATE of the prices changed.
+    """
+    pulled = []
+    for it in items:
+        it = it._replace(update_date=update_date)
+        if rng.random() < HISTORY_CHANGE_RATE:
+            it = it._replace(price_amazon='${}.{:02d}'.format(rng.randint(1, 120), rng.randint(0, 99)))
+        pulled.append(it)
+    return pulled
+
+
+def bench_catalog(scale: int, db_file: str, seed: int = 0) -> Dict[str, float]:
+    """
+    Time the pipeline on a synthetic catalog: parse every list with build_items_list, load HISTORY_PULLS pulls with
+    db.load_data, then query, render and analyze the resulting database. Last, measure the peak memory of reading
+    and rendering every current item, and of parsing and loading one more list.
+    :param scale: number of items in the catalog
+    :param db_file: new database file to build the history in
+    :param seed: seed of the synthetic catalog
+    :return: dict of timings in seconds, and of peak memory in bytes for the keys ending in _bytes
+    """
+    import analyze
+    import db
+    import main
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    rng = random.Random(seed)
+    today = dt.datetime.now().replace(microsecond=0)
+    dates = [str(today - dt.timedelta(days=HISTORY_PULLS - 1 - n)) for n in range(HISTORY_PULLS)]
+    result = {'items': scale, 'build_items_list': 0.0, 'load_data_first': 0.0, 'load_data_next': 0.0}
+    db.open_session(db_file)
+    try:
+        for name, list_html in iter_catalog_lists(scale, seed):
+            start = time.perf_counter()
+            items = amazon.build_items_list(amazon.parse_html(list_html, name, dump=False), name)
+            result['build_items_list'] += time.perf_counter() - start
+            for n, update_date in enumerate(dates):
+                items = [it._replace(update_date=update_date) for it in items] if n == 0 \
+                    else next_pull(items, update_date, rng)
+                start = time.perf_counter()
+                db.load_data(items)
+                result['load_data_first' if n == 0 else 'load_data_next'] += time.perf_counter() - start
+        result['load_data_next'] /= max(1, HISTORY_PULLS - 1)
+
+        session = db.get_session()
+
+        def uncached(func):
+            # time the query itself rather than the query cache
+            def run():
+                session.clear_cache()
+                return func()
+            return run
+
+        timings = [('get_current_items_page', lambda: db.get_current_items(limit=100)),
+                   ('get_current_items_page_by_price', lambda: db.get_current_items(
+                       order_by='price_amazon', descending=True, limit=100)),
+                   ('get_current_items_search', lambda: db.get_current_items(search='gardening volume', limit=100)),
+                   ('count_current_items', lambda: db.count_current_items())]
+        for key, func in timings:
+            result[key] = best_time(uncached(func), 3)[0]
+            result[key + '_cached'] = best_time(func, 3)[0]
+        result['get_current_items_all'], items = best_time(uncached(db.get_current_items), 1)
+        result['make_headers_and_rows'] = best_time(lambda: main.make_headers_and_rows(items), 1)[0]
+        del items
+
+        result['load_chart_columns'], columns = best_time(uncached(analyze.load_chart_columns), 3)
+        result['load_chart_columns_cached'] = best_time(analyze.load_chart_columns, 3)[0]
+        result['plot_price_histogram'] = best_time(lambda: analyze.plot_price_histogram(columns['price']), 1)[0]
+        result['plot_ratings_reviews'] = best_time(
+            lambda: analyze.plot_ratings_reviews(columns['rating'], columns['num_reviews']), 1)[0]
+        plt.close('all')
+        result['load_price_history'], history = best_time(uncached(analyze.load_price_history), 3)
+        result['price_stats'] = best_time(lambda: analyze.price_stats(history), 3)[0]
+        result['best_deals'] = best_time(uncached(analyze.best_deals), 3)[0]
+        result['best_deals_cached'] = best_time(analyze.best_deals, 3)[0]
+
+        result['current_items_peak_bytes'] = peak_memory(
+            uncached(lambda: main.make_headers_and_rows(db.get_current_items())))
+        list_html = make_list_html(scale, CATALOG_LIST_SIZE, seed)
+        result['ingest_peak_bytes'] = peak_memory(lambda: db.load_data(amazon.build_items_list(
+            amazon.parse_html(list_html, 'Synthetic ingest', dump=False), 'Synthetic ingest')))
+    finally:
+        db.close_session()
+    return result
+
+
+def run_catalog_suite(scales: List[int], seed: int = 0) -> Dict[str, Any]:
+    """
+    Run bench_catalog at each scale in a throwaway database.
+    :return: dict of the run's settings and results by scale, as saved to JSON
+    """
+    run = {'date': str(dt.datetime.now()), 'python': platform.python_version(), 'platform': platform.platform(),
+           'html_parser': amazon.HTML_PARSER, 'list_size': CATALOG_LIST_SIZE, 'history_pulls': HISTORY_PULLS,
+           'seed': seed, 'results': {}}
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            print('Catalog of', scale, 'items')
+            run['results'][str(scale)] = bench_catalog(scale, str(pathlib.Path(tmp).joinpath('catalog.db')), seed)
+    return run
+
+
+@contextlib.contextmanager
+def serve_pages(pages: Dict[str, str]) -> Any:
+    """
+    Serve html pages on localhost for the with block, anything else is answered with 404.
+    :param pages: dict of path, with its query string, to html
+    :return: base url of the server, e.g. http://127.0.0.1:8000
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            page = pages.get(self.path)
+            if page is None:
+                self.send_error(404)
+                return
+            body = page.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:' + str(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def check_http_backend() -> List[str]:
+    """
+    Fetch synthetic lists from a local server with the http backend: a list of three pages chained by showMoreUrl,
+    one relative to the page, with an escaped query string, and one relative to the host, a page whose showMoreUrl
+    points back at itself, a page without items and a missing page. The last two must fall back to selenium.
+    :return: list of the checks that failed, empty if all passed
+    """
+    pages = {'/list/1': make_list_html(0, 50, show_more_url='page2?lek=a&ref=b'),
+             '/list/page2?lek=a&ref=b': make_list_html(50, 50, show_more_url='/list/3'),
+             '/list/3': make_list_html(100, 20),
+             '/loop': make_list_html(0, 10, show_more_url='/loop'),
+             '/empty': make_list_html(0, 0)}
+    failures = []
+
+    def check(ok, message):
+        print(('ok     ' if ok else 'FAILED ') + message)
+        if not ok:
+            failures.append(message)
+
+    with serve_pages(pages) as base, amazon.make_http_session() as session:
+        list_html = amazon.try_list_html_http(session, base + '/list/1', name='paged')
+        expected = '\n'.join(pages[p] for p in ('/list/1', '/list/page2?lek=a&ref=b', '/list/3'))
+        check(list_html == expected, 'a list of three pages is joined in order')
+        check(list_html is not None and len(list(amazon.iter_item_fragments(list_html))) == 120,
+              'every item of the three pages is found')
+        check(amazon.try_list_html_http(session, base + '/loop', name='loop') == pages['/loop'],
+              'a page linking to itself is fetched once')
+        check(amazon.try_list_html_http(session, base + '/empty', name='empty') is None,
+              'a page without items falls back to selenium')
+        check(amazon.try_list_html_http(session, base + '/missing', name='missing') is None,
+              'a missing page falls back to selenium')
+    return failures
+
+
+def print_catalog_run(run: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Print a run's timings and peak memory by scale, with the ratio to the baseline run where it has the same
+    measurement.
+    """
+    for scale, result in run['results'].items():
+        base = {} if baseline is None else baseline['results'].get(scale, {})
+        print(f'{scale} items')
+        for key, value in result.items():
+            if key == 'items':
+                continue
+            if key.endswith('_bytes'):
+                line = f'  {key:40} {value / 2 ** 20:11.1f} MiB'
+            else:
+                line = f'  {key:40} {value * 1000:11.3f} ms'
+            if base.get(key):
+                line += f'  {value / base[key]:6.2f}x baseline'
+            print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark list page parsing on recorded list html, and the start '
+                                                 'of the GUI.')
+    parser.add_argument('html_files', nargs='*', help='recorded list pages, e.g. ~/bookshelf/debug/*.html')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the fastest is reported')
+    parser.add_argument('--startup', action='store_true', help='time imports and the first window of the GUI')
+    parser.add_argument('--db', help='database opened by --startup, ~/bookshelf/database.db by default')
+    parser.add_argument('--catalog', action='store_true', help='run the synthetic catalog suite')
+    parser.add_argument('--http', action='store_true', help='check the http fetch backend against a local server')
+    parser.add_argument('--scales', type=int, nargs='+', default=list(SCALES), help='catalog sizes to run')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic catalog')
+    parser.add_argument('--output', help='JSON file for the catalog results, in ~/bookshelf/benchmarks by default')
+    parser.add_argument('--compare', help='JSON file of an earlier catalog run to compare with')
+    args = parser.parse_args()
+    for file_name in args.html_files:
+        path = pathlib.Path(file_name).expanduser()
+        print_parse_result(path.name, bench_parse(path.read_text(encoding='utf-8'), args.repeat))
+    if args.catalog:
+        catalog_run = run_catalog_suite(args.scales, args.seed)
+        output = pathlib.Path(args.output).expanduser() if args.output else CATALOG_RESULTS_DIR.joinpath(
+            'catalog-' + dt.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with output.open(mode='w') as f:
+            json.dump(catalog_run, f, indent=2)
+        baseline_run = None
+        if args.compare:
+            with pathlib.Path(args.compare).expanduser().open(mode='r') as f:
+                baseline_run = json.load(f)
+        print_catalog_run(catalog_run, baseline_run)
+        print('Saved results to', output)
+    if args.http and len(check_http_backend()) > 0:
+        sys.exit(1)
+    if args.startup and not print_startup_result(bench_startup(args.db, args.repeat)):
+        sys.exit(1)
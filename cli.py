@@ -0,0 +1,255 @@
+"""
+Pull lists without the GUI, once or on a schedule.
+
+    python cli.py pull                  pull every list in list_urls.json now
+    python cli.py pull --list Books     pull only the named lists
+    python cli.py lists                 show each list's interval, last pull and next scheduled pull
+    python cli.py daemon                keep pulling each list on its own schedule until stopped
+
+A list in list_urls.json can set how often it is pulled, e.g. {"name": "Books", "url": "...", "interval_hours": 6},
+otherwise it is pulled every DEFAULT_INTERVAL_HOURS. Pulls take the same lock as the GUI's Pull Lists, so the two
+never overlap.
+"""
+
+import amazon
+import argparse
+import datetime as dt
+import db
+import listutils
+import metrics
+import random
+import signal
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# hours between pulls of a list that doesn't set interval_hours
+DEFAULT_INTERVAL_HOURS = 24
+# fraction of a list's interval its pulls are moved by at random, either way, so lists don't stay lined up
+JITTER = 0.05
+# seconds before retrying a list after its first failure, doubled after each further failure
+BACKOFF_BASE = 300
+# longest wait between retries of a failing list, in seconds
+BACKOFF_MAX = 6 * 3600
+# seconds before trying again when another pull holds the pull lock
+LOCK_RETRY = 60
+# longest the scheduler sleeps before reading list_urls.json again for added or removed lists, in seconds
+MAX_SLEEP = 60
+
+
+def list_interval(url: Dict[str, Any]) -> float:
+    """
+    :param url: dict of a list from list_urls.json
+    :return: seconds between pulls of the list
+    """
+    return float(url.get('interval_hours', DEFAULT_INTERVAL_HOURS)) * 3600
+
+
+def parse_date(date: Optional[str]) -> Optional[float]:
+    """
+    :param date: update date as stored by db, e.g. '2021-03-04 05:06:07.890123'
+    :return: unix timestamp, None if there is no date
+    """
+    return None if date is None else dt.datetime.fromisoformat(date).timestamp()
+
+
+def format_time(timestamp: Optional[float]) -> str:
+    return 'never' if timestamp is None else dt.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+class Scheduler:
+    """
+    Decides when each list is pulled next. Every list gets a slot in its interval, with the lists spread evenly
+    over it, and is pulled once per interval at its slot, give or take JITTER. So 24 lists pulled daily are pulled
+    an hour apart rather than all at once. A list that was never pulled is due at once. A list that failed is retried
+    with exponential backoff, from BACKOFF_BASE up to BACKOFF_MAX, and goes back to its slot once it succeeds.
+    """
+
+    def __init__(self, max_workers: int = listutils.MAX_WORKERS, timeout: float = amazon.LIST_TIMEOUT,
+                 backend: str = amazon.FETCH_BACKEND, use_cache: bool = listutils.PAGE_CACHE,
+                 jitter: float = JITTER, rng: Optional[random.Random] = None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.backend = backend
+        self.use_cache = use_cache
+        self.jitter = jitter
+        self.rng = random.Random() if rng is None else rng
+        self.urls = {}
+        self.phases = {}
+        self.next_run = {}
+        self.failures = {}
+
+    def refresh(self, list_urls: List[Dict[str, Any]], last_pulls: Dict[str, Optional[float]], now: float) -> None:
+        """
+        Take up the lists as they are now, scheduling lists not seen before and dropping removed ones.
+        :param list_urls: list of dicts of names, urls and optional interval_hours, as in list_urls.json
+        :param last_pulls: dict of list name to the timestamp of its last successful pull
+        :param now: current timestamp
+        """
+        self.urls = {url['name']: url for url in list_urls}
+        names = sorted(self.urls)
+        self.phases = {name: n / len(names) for n, name in enumerate(names)}
+        for name in list(self.next_run):
+            if name not in self.urls:
+                del self.next_run[name]
+                self.failures.pop(name, None)
+        for name in names:
+            if name not in self.next_run:
+                last = last_pulls.get(name)
+                self.next_run[name] = now if last is None else self.slot_after(name, last)
+
+    def slot_after(self, name: str, last: float) -> float:
+        """
+        When a list pulled at last is next pulled: at its first slot at least half an interval later, with jitter.
+        :param name: name of the list
+        :param last: timestamp of the list's last pull
+        :return: timestamp
+        """
+        interval = list_interval(self.urls[name])
+        offset = self.phases[name] * interval
+        earliest = last + interval / 2
+        slot = offset + interval * -(-(earliest - offset) // interval)
+        return slot + self.rng.uniform(-self.jitter, self.jitter) * interval
+
+    def due(self, now: float) -> List[Dict[str, Any]]:
+        return [self.urls[name] for name, when in sorted(self.next_run.items(), key=lambda x: x[1]) if when <= now]
+
+    def next_due(self) -> Optional[float]:
+        return min(self.next_run.values()) if len(self.next_run) > 0 else None
+
+    def finished(self, name: str, failed: bool, now: float) -> None:
+        """
+        Schedule a list's next pull after it was pulled.
+        :param name: name of the list
+        :param failed: the pull of the list failed
+        :param now: when the pull finished
+        """
+        if name not in self.urls:
+            return
+        if failed:
+            self.failures[name] = self.failures.get(name, 0) + 1
+            backoff = min(BACKOFF_BASE * 2 ** (self.failures[name] - 1), BACKOFF_MAX,
+                          list_interval(self.urls[name]))
+            self.next_run[name] = now + backoff * (1 + self.rng.uniform(0, self.jitter))
+        else:
+            self.failures.pop(name, None)
+            self.next_run[name] = self.slot_after(name, now)
+
+    def pull(self, list_urls: List[Dict[str, Any]], cancel: threading.Event) -> None:
+        """
+        Pull lists now, up to max_workers at once, and schedule their next pulls.
+        :param list_urls: lists to pull
+        :param cancel: set to stop the pull
+        """
+        names = [url['name'] for url in list_urls]
+        print(format_time(time.time()), 'Pulling', ', '.join(names))
+        try:
+            failures = listutils.download_lists(list_urls, self.max_workers, self.timeout, self.backend,
+                                                cancel=cancel, use_cache=self.use_cache)
+        except listutils.PullLocked as e:
+            print(e, '- trying again in', LOCK_RETRY, 'seconds')
+            for name in names:
+                self.next_run[name] = time.time() + LOCK_RETRY
+            return
+        now = time.time()
+        for name in names:
+            self.finished(name, name in failures, now)
+            if name in failures:
+                print('Failed', name, '-', failures[name], '- retrying at', format_time(self.next_run.get(name)))
+
+    def run(self, stop: threading.Event) -> None:
+        """
+        Pull lists as they fall due until stop is set.
+        :param stop: set to stop the scheduler, a pull in progress is cancelled
+        """
+        while not stop.is_set():
+            now = time.time()
+            self.refresh(listutils.get_lists_from_file('list_urls.json'),
+                         {k: parse_date(v) for k, v in db.get_list_pull_dates().items()}, now)
+            due = self.due(now)
+            if len(due) > 0:
+                self.pull(due, stop)
+                continue
+            next_due = self.next_due()
+            stop.wait(MAX_SLEEP if next_due is None else min(MAX_SLEEP, max(0.0, next_due - now)))
+
+
+def pull_once(names: Optional[List[str]], args: Any) -> int:
+    """
+    Pull lists now and print their progress.
+    :param names: names of the lists to pull, every list if None or empty
+    :return: exit status, 0 if every list was pulled, 1 if some failed, 2 if another pull is running
+    """
+    list_urls = listutils.get_lists_from_file('list_urls.json')
+    if names:
+        unknown = set(names) - {url['name'] for url in list_urls}
+        if len(unknown) > 0:
+            print('Unknown lists:', ', '.join(sorted(unknown)))
+            return 1
+        list_urls = [url for url in list_urls if url['name'] in names]
+
+    def progress(name, count, error, done, total):
+        result = 'failed: ' + error if error is not None else str(count) + ' items'
+        print('Pulled', done, 'of', total, 'lists (' + name, result + ')')
+
+    try:
+        failures = listutils.download_lists(list_urls, args.workers, args.timeout, args.backend,
+                                            on_progress=progress, use_cache=not args.no_cache)
+    except listutils.PullLocked as e:
+        print(e)
+        return 2
+    return 1 if len(failures) > 0 else 0
+
+
+def show_lists() -> None:
+    """
+    Print each list with its interval, last successful pull and the slot the scheduler would pull it at next.
+    """
+    list_urls = listutils.get_lists_from_file('list_urls.json')
+    last_pulls = {k: parse_date(v) for k, v in db.get_list_pull_dates().items()}
+    scheduler = Scheduler(jitter=0)
+    scheduler.refresh(list_urls, last_pulls, time.time())
+    for url in list_urls:
+        name = url['name']
+        print(f"{name:30} every {list_interval(url) / 3600:5.1f} h  last {format_time(last_pulls.get(name))}"
+              f"  next {format_time(scheduler.next_run[name])}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Pull Amazon lists without the GUI.')
+    parser.add_argument('--workers', type=int, default=listutils.MAX_WORKERS,
+                        help='most lists fetched at once')
+    parser.add_argument('--timeout', type=float, default=amazon.LIST_TIMEOUT, help='seconds allowed per list page')
+    parser.add_argument('--backend', choices=amazon.FETCH_BACKENDS, default=amazon.FETCH_BACKEND)
+    parser.add_argument('--no-cache', action='store_true', help='parse and save every list even if unchanged')
+    parser.add_argument('--metrics', action='store_true', help='record timings to ~/bookshelf/metrics')
+    commands = parser.add_subparsers(dest='command', required=True)
+    pull_parser = commands.add_parser('pull', help='pull lists now')
+    pull_parser.add_argument('--list', action='append', dest='names', help='name of a list to pull, repeatable')
+    commands.add_parser('lists', help='show the lists and when they are pulled')
+    commands.add_parser('daemon', help='pull each list on its schedule until stopped')
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+    try:
+        if args.command == 'pull':
+            return pull_once(args.names, args)
+        if args.command == 'lists':
+            show_lists()
+            return 0
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop.set())
+        scheduler = Scheduler(max(1, args.workers), args.timeout, args.backend, not args.no_cache)
+        scheduler.run(stop)
+        return 0
+    finally:
+        if metrics.enabled():
+            metrics.write_prometheus()
+        db.close_session()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
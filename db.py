@@ -4,20 +4,104 @@ Functions for creating and interacting with the database.
 Some parts taken from the SQLite tutorial.
 """
 
-import listutils
+import collections
+import contextlib
+from decimal import Decimal
+from itemrecord import CurrentItem, ItemRecord, item_identity
+import json
+import metrics
 import pathlib
+import re
 import sqlite3
 from sqlite3 import Error
+import threading
 import traceback
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
 
 DB_COLUMNS_LIST = ('name', 'by_line', 'price_amazon', 'price_used_new', 'rating', 'num_reviews', 'item_id',
                    'item_external_id', 'update_date', 'list_name')
 RETURN_COLUMNS_LIST = ('item_external_id', 'update_date', 'price_amazon', 'price_used_new', 'rating', 'num_reviews',
-                       'name', 'by_line', 'item_id', 'list_name')
+                       'name', 'by_line', 'item_id', 'list_name', 'price_amazon_minor', 'price_used_new_minor',
+                       'currency')
+# sort keys accepted by get_current_items and the column each one sorts on
+SORT_COLUMNS = {'name': 'items.name',
+                'by_line': 'items.by_line',
+                'price_amazon': 'rs.price_amazon_minor',
+                'rating': 'rs.rating',
+                'num_reviews': 'rs.num_reviews'}
+# weights of the name and by_line columns when ranking search results, a match in the title counts more
+SEARCH_WEIGHTS = (10.0, 3.0)
+SEARCH_TERM_RE = re.compile(r'\w+')
+CURRENCY_SYMBOLS = {'$': 'USD', '£': 'GBP', '€': 'EUR', '¥': 'JPY', '₹': 'INR'}
+PRICE_RE = re.compile(r'([^\d\s.,]*)\s*(\d[\d.,]*)\s*([^\d\s.,]*)')
+# a separator followed by exactly three digits is a thousands separator
+THOUSANDS_SEPARATOR_RE = re.compile(r'[.,](?=\d{3}(?:\D|$))')
 
 db_path = pathlib.Path.home().joinpath('bookshelf', 'database.db')
 
+# applied to every connection a Database opens
+CONNECTION_PRAGMAS = ('PRAGMA journal_mode = WAL',
+                      'PRAGMA synchronous = NORMAL',
+                      'PRAGMA cache_size = -32000',
+                      'PRAGMA mmap_size = 268435456',
+                      'PRAGMA temp_store = MEMORY')
+# seconds a connection waits for a lock held by another connection before raising
+BUSY_TIMEOUT = 30
+# items passed to each load_data call when loading the list dump
+LOAD_BATCH_SIZE = 10000
+# most query results each thread keeps in its QueryCache, 0 turns the cache off
+QUERY_CACHE_SIZE = 64
+# most rows kept in a QueryCache over all its results, a larger result is not kept at all
+QUERY_CACHE_ROWS = 250000
+
+
+def parse_price(price: Any) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Convert a price string as scraped, e.g. '$1,234.56', to an amount in minor units (cents) and a currency code.
+    :param price: price string
+    :return: tuple of amount in minor units and currency code, (None, None) if there is no price
+    """
+    if not isinstance(price, str):
+        return None, None
+    match = PRICE_RE.search(price)
+    if match is None:
+        return None, None
+    amount = THOUSANDS_SEPARATOR_RE.sub('', match.group(2).rstrip('.,')).replace(',', '.')
+    try:
+        minor = int((Decimal(amount) * 100).to_integral_value())
+    except ArithmeticError:
+        return None, None
+    symbol = match.group(1).strip()
+    if not symbol and match.group(3) in CURRENCY_SYMBOLS:
+        symbol = match.group(3)
+    return minor, CURRENCY_SYMBOLS.get(symbol, symbol or None)
+
+
+def parse_count(count: Any) -> Optional[int]:
+    """
+    Convert a count as scraped, e.g. '1,234', to an int.
+    :param count: count string or int
+    :return: int, None if it is not a number
+    """
+    if isinstance(count, int):
+        return count
+    try:
+        return int(str(count).replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+def parse_rating(rating: Any) -> Optional[float]:
+    """
+    Convert a rating to a float.
+    :param rating: rating as stored, a number or a placeholder string
+    :return: float, None if it is not a number
+    """
+    try:
+        return float(rating)
+    except (TypeError, ValueError):
+        return None
+
 
 def create_connection(db_file: str) -> Any:
     """
@@ -93,112 +177,853 @@ def create_records_table(conn):
         print("Error! Cannot create database connection.")
 
 
-def load_data(data, default_visible=1):
+# copies the newest record of each item into latest_records
+SQL_FILL_LATEST_RECORDS = """INSERT OR REPLACE INTO latest_records
+                                (item_external_id, update_date, price_amazon, price_used_new, rating, num_reviews)
+                             SELECT r.item_external_id, r.update_date, r.price_amazon, r.price_used_new, r.rating,
+                                r.num_reviews
+                             FROM records r JOIN
+                                (SELECT item_external_id, max(update_date) AS update_date
+                                FROM records GROUP BY item_external_id) m
+                             ON r.item_external_id = m.item_external_id AND r.update_date = m.update_date
+                             ORDER BY r.id"""
+
+
+def migrate_latest_records(conn):
     """
-    Load new data to items table.
-    :param data: list of dictionaries containing item data
-    :param default_visible: what to default the visible column to in items table
+    Schema version 1. Index items and records by item_external_id and fill latest_records from the existing records.
+    :param conn: Connection object
     :return:
     """
+    c = conn.cursor()
+    c.execute("""CREATE TABLE IF NOT EXISTS latest_records (
+                    item_external_id text PRIMARY KEY,
+                    update_date datetime,
+                    price_amazon text,
+                    price_used_new text,
+                    rating double,
+                    num_reviews int
+                )""")
+    c.execute('CREATE INDEX IF NOT EXISTS records_item_date ON records (item_external_id, update_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS items_item_external_id ON items (item_external_id)')
+    c.execute(SQL_FILL_LATEST_RECORDS)
 
-    item_columns = ['name', 'by_line', 'item_id', 'item_external_id', 'list_name', 'visible']
-    record_columns = ['item_external_id', 'update_date', 'price_amazon', 'price_used_new', 'rating', 'num_reviews']
-    sql_statement = """INSERT INTO 
-                            items
-                            (name, by_line, price_amazon, price_used_new, rating, num_reviews, item_id,
-                            item_external_id, update_date, list_name)
-                        VALUES
-                            (:name, :by_line, :price_amazon, :price_used_new, :rating, :num_reviews, :item_id,
-                            :item_external_id, :update_date, :list_name)"""
 
-    item_data = [{k: v for k, v in d.items() if k in item_columns} for d in data]
-    for it in item_data:
-        it['visible'] = str(default_visible)
-    record_data = [{k: v for k, v in d.items() if k in record_columns} for d in data]
+def assign_item_identities(conn):
+    """
+    Give the items without an item_external_id, such as ideas, their item_identity, so they are told apart when
+    items are made unique on it. Their records can't be told apart and are left under the empty id.
+    :param conn: Connection object
+    :return:
+    """
+    conn.create_function('item_identity', 3, item_identity, deterministic=True)
+    conn.execute("""UPDATE items SET item_external_id = item_identity(item_external_id, item_id, name)
+                    WHERE coalesce(item_external_id, '') = ''""")
+
+
+def migrate_unique_items(conn):
+    """
+    Schema version 2. Make items unique per item_external_id and list_name, with a last_seen date, and drop the
+    duplicate items and the records that repeat the previous record of their item unchanged. Items without an
+    item_external_id are kept apart by assign_item_identities.
+    :param conn: Connection object
+    :return:
+    """
+    c = conn.cursor()
+    c.execute('ALTER TABLE items ADD COLUMN last_seen datetime')
+    c.execute("""UPDATE items SET last_seen =
+                    (SELECT max(update_date) FROM records r WHERE r.item_external_id = items.item_external_id)""")
+    assign_item_identities(conn)
+    c.execute("""DELETE FROM items WHERE id NOT IN
+                    (SELECT max(id) FROM items GROUP BY item_external_id, list_name)""")
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS items_identity ON items (item_external_id, list_name)')
+    c.execute("""DELETE FROM records WHERE id IN
+                    (SELECT id FROM
+                        (SELECT id, price_amazon, price_used_new, rating, num_reviews,
+                            lag(price_amazon) OVER w AS prev_price_amazon,
+                            lag(price_used_new) OVER w AS prev_price_used_new,
+                            lag(rating) OVER w AS prev_rating,
+                            lag(num_reviews) OVER w AS prev_num_reviews,
+                            row_number() OVER w AS n
+                        FROM records
+                        WINDOW w AS (PARTITION BY item_external_id ORDER BY update_date, id))
+                    WHERE n > 1 AND price_amazon IS prev_price_amazon AND price_used_new IS prev_price_used_new
+                        AND rating IS prev_rating AND num_reviews IS prev_num_reviews)""")
+    c.execute('DELETE FROM latest_records')
+    c.execute(SQL_FILL_LATEST_RECORDS)
+
+
+def migrate_typed_values(conn):
+    """
+    Schema version 3. Store prices as integer minor units with a currency code next to the display strings, and
+    ratings and review counts as numbers, converting the existing records. Index the columns the GUI sorts on.
+    :param conn: Connection object
+    :return:
+    """
+    conn.create_function('parse_price_minor', 1, lambda p: parse_price(p)[0], deterministic=True)
+    conn.create_function('parse_price_currency', 1, lambda p: parse_price(p)[1], deterministic=True)
+    conn.create_function('parse_count', 1, parse_count, deterministic=True)
+    conn.create_function('parse_rating', 1, parse_rating, deterministic=True)
+    c = conn.cursor()
+    for table in ('records', 'latest_records'):
+        c.execute('ALTER TABLE ' + table + ' ADD COLUMN price_amazon_minor int')
+        c.execute('ALTER TABLE ' + table + ' ADD COLUMN price_used_new_minor int')
+        c.execute('ALTER TABLE ' + table + ' ADD COLUMN currency text')
+        c.execute('UPDATE ' + table + """ SET
+                    price_amazon_minor = parse_price_minor(price_amazon),
+                    price_used_new_minor = parse_price_minor(price_used_new),
+                    currency = coalesce(parse_price_currency(price_amazon), parse_price_currency(price_used_new)),
+                    rating = parse_rating(rating),
+                    num_reviews = parse_count(num_reviews)""")
+    c.execute('CREATE INDEX IF NOT EXISTS latest_records_price_amazon ON latest_records (price_amazon_minor)')
+    c.execute('CREATE INDEX IF NOT EXISTS latest_records_rating ON latest_records (rating)')
+    c.execute('CREATE INDEX IF NOT EXISTS latest_records_num_reviews ON latest_records (num_reviews)')
+    c.execute('CREATE INDEX IF NOT EXISTS items_name ON items (name)')
+    c.execute('CREATE INDEX IF NOT EXISTS items_by_line ON items (by_line)')
+
+
+def migrate_search_index(conn):
+    """
+    Schema version 4. Full-text index over the name and by_line of items, kept in sync with items by triggers so
+    every insert and upsert in load_data updates it.
+    :param conn: Connection object
+    :return:
+    """
+    c = conn.cursor()
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+                    name, by_line, content='items', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+    create_search_triggers(c)
+    c.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+
+def create_search_triggers(c):
+    """
+    Triggers that keep items_fts in sync with items.
+    :param c: Cursor object
+    :return:
+    """
+    c.execute("""CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+                    INSERT INTO items_fts (rowid, name, by_line) VALUES (new.id, new.name, new.by_line);
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+                    INSERT INTO items_fts (items_fts, rowid, name, by_line) VALUES ('delete', old.id, old.name,
+                        old.by_line);
+                 END""")
+    # upserts rewrite name and by_line on every pull, only reindex when they actually changed
+    c.execute("""CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, by_line ON items
+                 WHEN old.name IS NOT new.name OR old.by_line IS NOT new.by_line BEGIN
+                    INSERT INTO items_fts (items_fts, rowid, name, by_line) VALUES ('delete', old.id, old.name,
+                        old.by_line);
+                    INSERT INTO items_fts (rowid, name, by_line) VALUES (new.id, new.name, new.by_line);
+                 END""")
+
+
+def migrate_page_cache(conn):
+    """
+    Schema version 5. The hash of each list's page when it was last pulled, and the hash of the html of each item on
+    it with the item it holds, so a pull can skip lists and items that haven't changed.
+    :param conn: Connection object
+    :return:
+    """
+    c = conn.cursor()
+    c.execute("""CREATE TABLE IF NOT EXISTS list_pages (
+                    list_name text PRIMARY KEY,
+                    page_hash text NOT NULL,
+                    update_date text NOT NULL
+                 )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS list_fragments (
+                    list_name text NOT NULL,
+                    fragment_hash text NOT NULL,
+                    item_external_id text NOT NULL,
+                    PRIMARY KEY (list_name, fragment_hash)
+                 ) WITHOUT ROWID""")
+
+
+def migrate_list_membership(conn):
+    """
+    Schema version 6. Store each item once, however many lists it is on: items becomes one row per
+    item_external_id, lists holds the list names, and list_items which lists each item is on, with the item's id on
+    that list and when it was last seen there, as far as the page cache or the item's own dates tell. An item is
+    visible if it was visible on any list, and takes its name and by_line from the list it was last seen on. Records
+    already belong to the item through item_external_id.
+    Items still without an item_external_id get their item_identity first, see assign_item_identities.
+    :param conn: Connection object
+    :return:
+    """
+    c = conn.cursor()
+    assign_item_identities(conn)
+    c.execute("""CREATE TABLE IF NOT EXISTS lists (
+                    id integer PRIMARY KEY,
+                    name text NOT NULL UNIQUE
+                 )""")
+    c.execute("""INSERT OR IGNORE INTO lists (name)
+                    SELECT coalesce(list_name, '') FROM items
+                    UNION SELECT list_name FROM list_pages""")
+    c.execute("""CREATE TABLE IF NOT EXISTS list_items (
+                    list_id integer NOT NULL REFERENCES lists (id),
+                    item_external_id text NOT NULL,
+                    item_id text,
+                    last_seen datetime,
+                    PRIMARY KEY (list_id, item_external_id)
+                 ) WITHOUT ROWID""")
+    # items.last_seen is the item's latest date on any list since migration 2, so it is only kept for an item on one
+    # list. Otherwise the last pull of the list is taken if the page cache has the item on it, or the date is left
+    # for the next pull to fill in
+    c.execute("""INSERT OR REPLACE INTO list_items (list_id, item_external_id, item_id, last_seen)
+                    SELECT lists.id, items.item_external_id, items.item_id,
+                        coalesce(cached.update_date, CASE WHEN items.lists = 1 THEN items.last_seen END)
+                    FROM (SELECT *, count(*) OVER (PARTITION BY item_external_id) AS lists FROM items) items
+                    JOIN lists ON lists.name = coalesce(items.list_name, '')
+                    LEFT JOIN (SELECT DISTINCT list_fragments.list_name, item_external_id, update_date
+                               FROM list_fragments JOIN list_pages ON list_pages.list_name = list_fragments.list_name)
+                        cached ON cached.list_name = lists.name AND cached.item_external_id = items.item_external_id
+                    WHERE items.item_external_id IS NOT NULL""")
+    c.execute('CREATE INDEX IF NOT EXISTS list_items_item ON list_items (item_external_id)')
+    c.execute("""CREATE TABLE unique_items (
+                    id integer PRIMARY KEY,
+                    item_external_id text NOT NULL UNIQUE,
+                    name text NOT NULL,
+                    by_line text,
+                    visible int,
+                    last_seen datetime
+                 )""")
+    c.execute("""INSERT INTO unique_items (id, item_external_id, name, by_line, visible, last_seen)
+                    SELECT id, item_external_id, name, by_line, visible, last_seen FROM
+                        (SELECT id, item_external_id, name, by_line,
+                            max(visible) OVER w AS visible, max(last_seen) OVER w AS last_seen,
+                            row_number() OVER (PARTITION BY item_external_id ORDER BY last_seen DESC, id DESC) AS n
+                        FROM items
+                        WHERE item_external_id IS NOT NULL
+                        WINDOW w AS (PARTITION BY item_external_id))
+                    WHERE n = 1""")
+    for trigger in ('items_fts_insert', 'items_fts_delete', 'items_fts_update'):
+        c.execute('DROP TRIGGER IF EXISTS ' + trigger)
+    c.execute('DROP TABLE items')
+    c.execute('ALTER TABLE unique_items RENAME TO items')
+    c.execute('CREATE INDEX IF NOT EXISTS items_name ON items (name)')
+    c.execute('CREATE INDEX IF NOT EXISTS items_by_line ON items (by_line)')
+    create_search_triggers(c)
+    c.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+
+# schema migrations in order, PRAGMA user_version holds how many have been applied
+MIGRATIONS = [migrate_latest_records, migrate_unique_items, migrate_typed_values, migrate_search_index,
+              migrate_page_cache, migrate_list_membership]
+
+
+def migrate(conn):
+    """
+    Apply the migrations the database has not had yet, each in its own transaction.
+    :param conn: Connection object
+    :return:
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.execute('BEGIN')
+            migration(conn)
+            conn.execute('PRAGMA user_version = ' + str(number))
+            conn.commit()
+        except Error:
+            conn.rollback()
+            raise
+
+
+def init_db(conn):
+    """
+    Create the tables if they don't exist and bring the schema up to date.
+    :param conn: Connection object
+    :return:
+    """
+    create_items_table(conn)
+    create_records_table(conn)
+    migrate(conn)
+
+
+class QueryCache:
+    """
+    Least recently used cache of query results, bounded by the number of results and the rows in them. Results are
+    kept for one data version of the database: the first lookup after the database changed drops them all, so a
+    result is never stale and checking costs one PRAGMA.
+    """
+
+    def __init__(self, size: int = QUERY_CACHE_SIZE, max_rows: int = QUERY_CACHE_ROWS):
+        self.size = size
+        self.max_rows = max_rows
+        self.rows = 0
+        self.version = None
+        self._results = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def clear(self) -> None:
+        self._results.clear()
+        self.rows = 0
+
+    def get(self, key: Hashable, version: Any, compute: Callable[[], Any],
+            rows: Optional[Callable[[Any], int]] = None) -> Any:
+        """
+        The cached result of a query, computed and kept if it isn't cached.
+        :param key: the query and its parameters
+        :param version: the database's current data version, see Database.data_version
+        :param compute: runs the query, what it raises is passed on and nothing is kept
+        :param rows: gives the number of rows in a result, len if None
+        :return: result of compute
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+        cached = self._results.get(key)
+        if cached is not None:
+            self._results.move_to_end(key)
+            metrics.count('query_cache_hits', query=key[0])
+            return cached[0]
+        metrics.count('query_cache_misses', query=key[0])
+        result = compute()
+        size = len(result) if rows is None else rows(result)
+        if self.size <= 0 or size > self.max_rows:
+            return result
+        self._results[key] = (result, size)
+        self.rows += size
+        while len(self._results) > self.size or self.rows > self.max_rows:
+            self.rows -= self._results.popitem(last=False)[1][1]
+        return result
+
+
+class Database:
+    """
+    A long-lived session on the SQLite database, opened once and shared by the whole app.
+    The schema is created and migrated when the session opens. Writes go through transaction(), which serializes
+    writers from any thread on a single connection. Reads use a separate connection per thread, so with WAL the GUI
+    can read while a pull is writing, and repeated reads are served by a QueryCache per thread through cached().
+    """
+
+    def __init__(self, path: Any = db_path):
+        self.path = str(path)
+        self._write_lock = threading.RLock()
+        self._depth = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._connections_lock = threading.Lock()
+        self._connections = []
+        self._writer = self._connect()
+        init_db(self._writer)
+
+    def _connect(self) -> sqlite3.Connection:
+        # transactions are begun and ended explicitly, so the connection is kept in autocommit mode
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        """
+        The calling thread's read connection, opened on first use.
+        :return: Connection object
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def close_reader(self) -> None:
+        """
+        Close the calling thread's read connection and drop its cached query results, for threads that end before
+        the session does. The thread opens a new connection if it reads again.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        self._local.cache = None
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Run the with block in a write transaction, committed at the end of the block and rolled back if it raises.
+        Nested transactions become savepoints of the outer one, so several loads can be batched into one commit.
+        :return: cursor on the write connection
+        """
+        with self._write_lock:
+            savepoint = 'sp' + str(self._depth)
+            self._writer.execute('SAVEPOINT ' + savepoint if self._depth else 'BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield self._writer.cursor()
+            except BaseException:
+                self._depth -= 1
+                if self._depth:
+                    self._writer.execute('ROLLBACK TO ' + savepoint)
+                    self._writer.execute('RELEASE ' + savepoint)
+                else:
+                    self._writer.execute('ROLLBACK')
+                raise
+            else:
+                self._depth -= 1
+                self._writer.execute('RELEASE ' + savepoint if self._depth else 'COMMIT')
+                if not self._depth:
+                    self._writes += 1
+
+    def data_version(self) -> Tuple[int, int]:
+        """
+        A value that changes whenever the database changes, through this session or any other connection, for
+        knowing when results computed from the database are stale.
+        :return: tuple of the session's commit count and the reader's PRAGMA data_version
+        """
+        return self._writes, self.reader().execute('PRAGMA data_version').fetchone()[0]
+
+    def cached(self, key: Hashable, compute: Callable[[], Any], rows: Optional[Callable[[Any], int]] = None) -> Any:
+        """
+        A query result from the calling thread's QueryCache, computed if the database changed since it was cached.
+        Cached results are shared between callers, so they must not be modified.
+        :param key: tuple of the query's name and everything its result depends on
+        :param compute: runs the query
+        :param rows: gives the number of rows in a result, len if None
+        :return: result of compute
+        """
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = QueryCache()
+            self._local.cache = cache
+        return cache.get(key, self.data_version(), compute, rows)
+
+    def clear_cache(self) -> None:
+        """
+        Drop the calling thread's cached query results.
+        """
+        cache = getattr(self._local, 'cache', None)
+        if cache is not None:
+            cache.clear()
+
+    def close(self) -> None:
+        """
+        Close every connection of the session.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def open_session(path: Any = None) -> Database:
+    """
+    Open the app's database session, closing any session already open.
+    :param path: database file, db_path by default
+    :return: Database
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = Database(db_path if path is None else path)
+        return _session
+
+
+def get_session() -> Database:
+    """
+    The app's database session, opened on db_path if nothing opened one yet.
+    :return: Database
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = Database(db_path)
+        return _session
+
+
+def close_session() -> None:
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def latest_items(data: Any) -> List[ItemRecord]:
+    """
+    :param data: iterable of ItemRecord, an item may be on several lists
+    :return: list of the last seen ItemRecord of each item, with its item_identity, in the order the items first
+    appear
+    """
+    latest = {}
+    for it in data:
+        it = it.with_identity()
+        seen = latest.get(it.item_external_id)
+        if seen is None or it.update_date > seen.update_date:
+            latest[it.item_external_id] = it
+    return list(latest.values())
+
+
+def get_list_ids(c: sqlite3.Cursor, names: Any) -> Dict[str, int]:
+    """
+    The ids of lists in the lists table, adding the lists that aren't in it.
+    :param c: cursor in a write transaction
+    :param names: iterable of list names
+    :return: dict of list name to id
+    """
+    names = set(names)
+    c.executemany('INSERT OR IGNORE INTO lists (name) VALUES (?)', ((name,) for name in names))
+    return {name: list_id for name, list_id in c.execute('SELECT name, id FROM lists') if name in names}
+
+
+def item_rows(data: Any, visible: str) -> Iterator[Tuple]:
+    """
+    :param data: iterable of ItemRecord, one per item
+    :param visible: value of the visible column of new items
+    :return: generator of parameter tuples of the items table, in load_data's item_columns order
+    """
+    for it in data:
+        yield it.item_external_id, it.name, it.by_line, visible, it.update_date
+
+
+def list_item_rows(data: Any, list_ids: Dict[str, int]) -> Iterator[Tuple]:
+    """
+    :param data: iterable of ItemRecord
+    :param list_ids: dict of list name to id, an item without a list_name is on the list named ''
+    :return: generator of parameter tuples of the list_items table, in load_data's list_item_columns order
+    """
+    for it in data:
+        yield list_ids[it.list_name or ''], it.with_identity().item_external_id, it.item_id, it.update_date
+
+
+def record_rows(data: Any) -> Iterator[Tuple]:
+    """
+    :param data: iterable of ItemRecord
+    :return: generator of parameter tuples of the records table, with the values converted, in load_data's
+    record_columns order
+    """
+    for it in data:
+        price_amazon_minor, currency = parse_price(it.price_amazon)
+        price_used_new_minor, used_new_currency = parse_price(it.price_used_new)
+        yield (it.item_external_id, it.update_date, it.price_amazon, it.price_used_new, parse_rating(it.rating),
+               parse_count(it.num_reviews), price_amazon_minor, price_used_new_minor, currency or used_new_currency)
+
+
+def load_data(data: List[ItemRecord], default_visible=1):
+    """
+    Load new data to the items, list_items and records tables.
+    Prices are stored as scraped for display, and as integer minor units with a currency code for sorting and
+    analysis. Ratings and review counts are stored as numbers.
+    An item is stored once however many lists it is on. Items are upserted on their item_identity, which is the
+    item_external_id unless the item has none, so an item already
+    in the table only has its details and last_seen date updated and keeps its visibility, and list_items records
+    which lists it is on. An item in data several times, e.g. on several lists, is written to items and records once,
+    with its values from the list it was last seen on. A record is only added when the price, rating or number of
+    reviews differs from the item's latest record.
+    The parameters of each statement are generated one item at a time, so no converted copy of the data is held.
+    :param data: list of ItemRecord, read once per statement
+    :param default_visible: what to default the visible column to in items table
+    :return: True if the data was saved
+    """
+
+    item_columns = ['item_external_id', 'name', 'by_line', 'visible', 'last_seen']
+    list_item_columns = ['list_id', 'item_external_id', 'item_id', 'last_seen']
+    record_columns = ['item_external_id', 'update_date', 'price_amazon', 'price_used_new', 'rating', 'num_reviews',
+                      'price_amazon_minor', 'price_used_new_minor', 'currency']
+    tracked_columns = record_columns[2:6]
+    # numbered parameters, so a value used more than once in a statement is passed once
+    item_params = ['?' + str(n + 1) for n in range(len(item_columns))]
+    list_item_params = ['?' + str(n + 1) for n in range(len(list_item_columns))]
+    record_params = {c: '?' + str(n + 1) for n, c in enumerate(record_columns)}
 
     sql_items = """INSERT INTO items
                         (""" + ','.join(item_columns) + """)
                         VALUES
-                        (:""" + ', :'.join(item_columns) + """)"""
+                        (""" + ', '.join(item_params) + """)
+                        ON CONFLICT (item_external_id) DO UPDATE SET
+                        name = excluded.name, by_line = excluded.by_line, last_seen = excluded.last_seen
+                        WHERE items.last_seen IS NULL OR excluded.last_seen >= items.last_seen"""
+    sql_list_items = """INSERT INTO list_items
+                        (""" + ','.join(list_item_columns) + """)
+                        VALUES
+                        (""" + ', '.join(list_item_params) + """)
+                        ON CONFLICT (list_id, item_external_id) DO UPDATE SET
+                        item_id = excluded.item_id, last_seen = excluded.last_seen"""
+    # the second check skips a record already loaded for the same pull. ?1 is item_external_id and ?2 update_date.
     sql_records = """INSERT INTO records
+                            (""" + ','.join(record_columns) + """)
+                            SELECT
+                            """ + ', '.join(record_params.values()) + """
+                            WHERE NOT EXISTS
+                                (SELECT 1 FROM latest_records l WHERE l.item_external_id = ?1
+                                AND """ + ' AND '.join('l.' + c + ' IS ' + record_params[c]
+                                                       for c in tracked_columns) + """)
+                            AND NOT EXISTS
+                                (SELECT 1 FROM records r WHERE r.item_external_id = ?1 AND r.update_date = ?2)"""
+    sql_latest_records = """INSERT INTO latest_records
                             (""" + ','.join(record_columns) + """)
                             VALUES
-                            (:""" + ', :'.join(record_columns) + """)"""
-    conn = create_connection(db_path)
-    with conn:
-        create_items_table(conn)
-        create_records_table(conn)
-        try:
-            c = conn.cursor()
-            # c.executemany(sql_statement, data)
-            c.executemany(sql_items, item_data)
-            c.executemany(sql_records, record_data)
-            conn.commit()
-        except Error as e:
-            print(e, ' in load_data')
-            traceback.print_exc()
+                            (""" + ', '.join(record_params.values()) + """)
+                            ON CONFLICT (item_external_id) DO UPDATE SET
+                            """ + ', '.join(c + ' = excluded.' + c for c in record_columns[1:]) + """
+                            WHERE excluded.update_date >= latest_records.update_date
+                            AND NOT (""" + ' AND '.join('latest_records.' + c + ' IS excluded.' + c
+                                                          for c in tracked_columns) + ')'
+    try:
+        with metrics.span('db_write'), get_session().transaction() as c:
+            items = latest_items(data)
+            c.executemany(sql_items, item_rows(items, str(default_visible)))
+            list_ids = get_list_ids(c, (it.list_name or '' for it in data))
+            c.executemany(sql_list_items, list_item_rows(data, list_ids))
+            c.executemany(sql_records, record_rows(items))
+            c.executemany(sql_latest_records, record_rows(items))
+    except Error as e:
+        print(e, ' in load_data')
+        traceback.print_exc()
+        return False
+    return True
 
 
-def convert_db_row(row: Tuple) -> Dict:
+def convert_db_row(row: Tuple) -> CurrentItem:
     """
-    SELECT statement returns rows as tuples. Convert tuple to dict.
-    :param row: tuple of single result row from database
-    :return: dict of item details, column names as keys
+    SELECT statement returns rows as tuples. Convert tuple to a CurrentItem, with its fields named by
+    RETURN_COLUMNS_LIST. The row holds the item's lists as one JSON array of [list name, item_id] pairs in place of
+    item_id and list_name, which become the ids and the names, comma separated in list name order. Sorting the pairs
+    here keeps each id with its list whatever order SQLite aggregated them in.
+    :param row: tuple of single result row from get_current_items
+    :return: CurrentItem
     """
-    return dict(zip(RETURN_COLUMNS_LIST, row))
+    memberships = sorted(json.loads(row[8]))
+    return CurrentItem(*row[:8], ', '.join(m[1] for m in memberships), ', '.join(m[0] for m in memberships),
+                       *row[9:])
 
 
-def get_current_items() -> List:
+def make_search_query(text: str) -> Optional[str]:
     """
-    Gets the unique items with the latest update_date from the database.
-    :return:
+    Turn text typed in the search box into an FTS5 query that matches items containing every word, with the words
+    allowed to be prefixes so results show up while a word is still being typed.
+    :param text: search text
+    :return: FTS5 MATCH expression, None if the text has no words
+    """
+    terms = SEARCH_TERM_RE.findall(text or '')
+    if len(terms) == 0:
+        return None
+    return ' '.join('"' + t + '"*' for t in terms)
+
+
+def current_items_from(order_by: Optional[str], search: Optional[str]) -> Tuple[str, List]:
+    """
+    The FROM and WHERE clauses shared by get_current_items and count_current_items.
+    :return: tuple of sql and its parameters
     """
-    sql_statement = """SELECT DISTINCT items.""" + ', '.join(RETURN_COLUMNS_LIST) + """ 
-                        FROM items LEFT JOIN
-                        (SELECT 
-                        item_external_id, update_date, price_amazon, price_used_new, rating, num_reviews
-                        FROM records r1
-                        WHERE
-                            r1.update_date = (SELECT max(update_date) FROM 
-                                records r2 WHERE r1.item_external_id = r2.item_external_id)) rs
-                        ON items.item_external_id=rs.item_external_id
-                        WHERE 
-                            items.visible = 1
-                            """
-    items = []
+    query = make_search_query(search)
+    if query is not None:
+        return """items_fts JOIN items ON items.id = items_fts.rowid
+                  JOIN latest_records rs ON items.item_external_id = rs.item_external_id
+                  WHERE items_fts MATCH ? AND items.visible = 1 """, [query]
+    # the table of the sort column drives the join so its index gives the order
+    if order_by is not None and SORT_COLUMNS[order_by].startswith('rs.'):
+        from_clause = 'latest_records rs CROSS JOIN items'
+    else:
+        from_clause = 'items JOIN latest_records rs'
+    return from_clause + """ ON items.item_external_id = rs.item_external_id
+                            WHERE items.visible = 1 """, []
+
+
+# the lists an item is on with its item_id on each, as a JSON array of pairs for convert_db_row
+SQL_ITEM_LISTS = """(SELECT json_group_array(json_array(lists.name, coalesce(list_items.item_id, '')))
+                        FROM list_items JOIN lists ON lists.id = list_items.list_id
+                        WHERE list_items.item_external_id = items.item_external_id)"""
+
+
+def get_current_items(order_by: Optional[str] = None, descending: bool = False, limit: Optional[int] = None,
+                      offset: int = 0, search: Optional[str] = None) -> List[CurrentItem]:
+    """
+    Gets the unique items from the database with their latest values from latest_records, one per item however
+    many lists it is on. The list_name of each item is the names of its lists and its item_id their ids for the item,
+    comma separated in the order of the list names. The update_date is the last time it was seen on any list.
+    Sorting is done by the database on indexed columns, with items that have no value for the sort key last.
+    Results are cached until the database changes, so the list returned must not be modified.
+    :param order_by: one of SORT_COLUMNS, or None for no particular order, or best match first when searching
+    :param descending: sort from largest to smallest
+    :param limit: most items to return, all of them if None
+    :param offset: number of items to skip, for reading the items a page at a time
+    :param search: only return items whose name or by_line contain words starting with each word of search
+    :return: list of CurrentItem
+    """
+    if order_by is not None and order_by not in SORT_COLUMNS:
+        raise ValueError('Cannot sort on ' + order_by)
+    from_clause, params = current_items_from(order_by, search)
+    sql_statement = """SELECT items.item_external_id, items.last_seen, price_amazon, price_used_new, rating,
+                        num_reviews, items.name, items.by_line,
+                        """ + SQL_ITEM_LISTS + """,
+                        price_amazon_minor, price_used_new_minor, currency
+                        FROM """ + from_clause
+    if order_by is not None:
+        sql_statement += 'ORDER BY ' + SORT_COLUMNS[order_by] + (' DESC' if descending else ' ASC') + ' NULLS LAST'
+    elif len(params) > 0:
+        sql_statement += 'ORDER BY bm25(items_fts, ' + ', '.join(str(w) for w in SEARCH_WEIGHTS) + ')'
+    if limit is not None:
+        sql_statement += ' LIMIT ' + str(int(limit)) + ' OFFSET ' + str(int(offset))
+
+    def query():
+        with metrics.span('db_query', query='get_current_items', order_by=order_by, search=len(params) > 0):
+            c = get_session().reader().cursor()
+            c.execute(sql_statement, params)
+            return [convert_db_row(r) for r in c]
+
     try:
-        conn = create_connection(db_path)
-        c = conn.cursor()
-        c.execute(sql_statement)
-        rows = c.fetchall()
-        items = [convert_db_row(r) for r in rows]
+        return get_session().cached(('get_current_items', sql_statement, tuple(params)), query)
     except Error as e:
         print(e, ' in get_current_items')
-    return items
+        return []
 
 
-def set_visibility(item_external_id: str, visibility: int):
+def search_items(text: str, limit: Optional[int] = 100) -> List:
     """
+    Find current items by words in their name or by_line, best matches first. Each word matches as a prefix, so
+    'tolk hob' finds The Hobbit by J.R.R. Tolkien.
+    :param text: search text
+    :param limit: most items to return, all of them if None
+    :return: list of CurrentItem like get_current_items
+    """
+    if make_search_query(text) is None:
+        return []
+    return get_current_items(limit=limit, search=text)
+
+
+def count_current_items(search: Optional[str] = None) -> int:
+    """
+    Count the items get_current_items returns.
+    :param search: search text, as for get_current_items
+    :return:
+    """
+    from_clause, params = current_items_from(None, search)
+    sql_statement = 'SELECT count(*) FROM ' + from_clause
+
+    def query():
+        with metrics.span('db_query', query='count_current_items', search=len(params) > 0):
+            return get_session().reader().execute(sql_statement, params).fetchone()[0]
+
+    try:
+        return get_session().cached(('count_current_items', sql_statement, tuple(params)), query, rows=lambda count: 1)
+    except Error as e:
+        print(e, ' in count_current_items')
+        return 0
+
+
+def get_price_history() -> Any:
+    """
+    Every record with an Amazon price, ordered by item and date, for loading the price history in bulk.
+    :return: cursor over tuples of item_external_id, update_date as a julian day number and price in minor units
+    """
+    sql_statement = """SELECT item_external_id, julianday(update_date), price_amazon_minor
+                        FROM records
+                        WHERE price_amazon_minor IS NOT NULL
+                        ORDER BY item_external_id, update_date"""
+    return get_session().reader().execute(sql_statement)
+
 
+def get_chart_columns() -> Any:
+    """
+    The latest price, rating and number of reviews of each visible item, once per item however many lists it is on.
+    :return: cursor over tuples of price_amazon_minor, rating and num_reviews, None where there is no value
+    """
+    sql_statement = """SELECT rs.price_amazon_minor, rs.rating, rs.num_reviews
+                        FROM latest_records rs
+                        WHERE EXISTS (SELECT 1 FROM items
+                            WHERE items.item_external_id = rs.item_external_id AND items.visible = 1)"""
+    return get_session().reader().execute(sql_statement)
+
+
+def get_list_pull_dates() -> Dict[str, str]:
+    """
+    When each list was last pulled successfully, as recorded by save_page_cache.
+    :return: dict of list name to update date
+    """
+    try:
+        return dict(get_session().reader().execute('SELECT list_name, update_date FROM list_pages'))
+    except Error as e:
+        print(e, ' in get_list_pull_dates')
+        return {}
+
+
+def get_page_cache(list_name: str) -> Tuple[Optional[str], Dict[str, str]]:
+    """
+    What a list looked like when it was last pulled.
+    :param list_name: name of the list
+    :return: tuple of the page hash, None if the list was never cached, and a dict of fragment hash to
+    item_external_id
+    """
+    conn = get_session().reader()
+    row = conn.execute('SELECT page_hash FROM list_pages WHERE list_name = ?', (list_name,)).fetchone()
+    fragments = conn.execute('SELECT fragment_hash, item_external_id FROM list_fragments WHERE list_name = ?',
+                             (list_name,))
+    return None if row is None else row[0], dict(fragments)
+
+
+def save_page_cache(list_name: str, page_hash: str, fragments: Dict[str, str], update_date: str,
+                    unchanged: bool = False) -> None:
+    """
+    Record what a list looked like when it was pulled, replacing what was cached for it, and mark the items on it as
+    seen, including the ones whose records were skipped because they hadn't changed.
+    :param list_name: name of the list
+    :param page_hash: hash of the list's page
+    :param fragments: dict of fragment hash to item_external_id of every item on the page
+    :param update_date: date of the pull
+    :param unchanged: the page hash is the cached one, so the cached fragments are kept as they are
+    """
+    try:
+        with get_session().transaction() as c:
+            c.execute("""INSERT INTO list_pages (list_name, page_hash, update_date) VALUES (?, ?, ?)
+                         ON CONFLICT (list_name) DO UPDATE SET
+                         page_hash = excluded.page_hash, update_date = excluded.update_date""",
+                      (list_name, page_hash, update_date))
+            if not unchanged:
+                c.execute('DELETE FROM list_fragments WHERE list_name = ?', (list_name,))
+                c.executemany("""INSERT OR REPLACE INTO list_fragments (list_name, fragment_hash, item_external_id)
+                                 VALUES (?, ?, ?)""", ((list_name, h, i) for h, i in fragments.items()))
+            list_id = get_list_ids(c, [list_name])[list_name]
+            item_external_ids = set(fragments.values())
+            c.executemany("""UPDATE list_items SET last_seen = ?
+                             WHERE list_id = ? AND item_external_id = ? AND (last_seen IS NULL OR last_seen < ?)""",
+                          ((update_date, list_id, i, update_date) for i in item_external_ids))
+            c.executemany('UPDATE items SET last_seen = ? WHERE item_external_id = ? AND last_seen < ?',
+                          ((update_date, i, update_date) for i in item_external_ids))
+    except Error as e:
+        print(e, ' in save_page_cache')
+        traceback.print_exc()
+
+
+def set_visibility(item_external_id: str, visibility: int):
+    """
+    Show or hide an item in every list it is on.
     :param item_external_id:
-    :param visibility:
+    :param visibility: 1 to show, 0 to hide
     :return:
     """
+    if not isinstance(visibility, int):
+        raise ValueError('visibility must be an int')
     sql_statement = """UPDATE items
-                        SET visible = """ + visibility + """
-                        WHERE item_external_id = """ + item_external_id
-    if visibility is not int:
-        raise ValueError()
+                        SET visible = ?
+                        WHERE item_external_id = ?"""
     try:
-        conn = create_connection(db_path)
-        c = conn.cursor()
-        c.execute(sql_statement)
+        with get_session().transaction() as c:
+            c.execute(sql_statement, (visibility, item_external_id))
     except Error as e:
         print(e, ' in set_visibility')
 
 
 if __name__ == '__main__':
-    conn = create_connection(db_path)
-    with conn:
-        data = listutils.load_list('listdump.json')
-        load_data(data, conn)
+    import itertools
+    import listutils
+
+    items = listutils.load_list()
+    batch = list(itertools.islice(items, LOAD_BATCH_SIZE))
+    while len(batch) > 0:
+        load_data(batch)
+        batch = list(itertools.islice(items, LOAD_BATCH_SIZE))
+    close_session()
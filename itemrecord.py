@@ -0,0 +1,76 @@
+"""
+Records of items as they pass from the parser to the database and from the database to the table.
+Both are named tuples, so an item is one compact tuple with no per-item dict, and a list of them is a single copy of
+the data.
+"""
+
+import hashlib
+from typing import Any, Dict, NamedTuple, Optional
+
+
+def item_identity(item_external_id: Optional[str], item_id: Optional[str], name: Optional[str]) -> str:
+    """
+    The key an item is stored under: its external id, or for an item without one, such as an idea, its id on the
+    list, or failing that a hash of its name.
+    :param item_external_id: itemExternalId of the item, '' or None if it has none
+    :param item_id: itemId of the item on its list
+    :param name: name of the item
+    :return: item_external_id, or a key prefixed with 'item:' or 'name:'
+    """
+    if item_external_id:
+        return item_external_id
+    if item_id:
+        return 'item:' + item_id
+    return 'name:' + hashlib.blake2b((name or '').encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ItemRecord(NamedTuple):
+    """
+    An item as scraped from a list, in DB_COLUMNS_LIST order. Values are kept as scraped, db.load_data converts
+    them.
+    """
+    name: str
+    by_line: str
+    price_amazon: str
+    price_used_new: str
+    rating: Any
+    num_reviews: str
+    item_id: str
+    item_external_id: str
+    update_date: str
+    list_name: str
+
+    @classmethod
+    def from_dict(cls, item: Dict[str, Any]) -> 'ItemRecord':
+        """
+        :param item: dict of item details, e.g. a line of the list dump. Missing fields are None.
+        :return: ItemRecord
+        """
+        return cls(*(item.get(f) for f in cls._fields))
+
+    def with_identity(self) -> 'ItemRecord':
+        """
+        :return: the record with item_external_id set to its item_identity
+        """
+        if self.item_external_id:
+            return self
+        return self._replace(item_external_id=item_identity(self.item_external_id, self.item_id, self.name))
+
+
+class CurrentItem(NamedTuple):
+    """
+    An item with its latest values, as returned by db.get_current_items, in RETURN_COLUMNS_LIST order.
+    """
+    item_external_id: str
+    update_date: str
+    price_amazon: str
+    price_used_new: str
+    rating: Optional[float]
+    num_reviews: Optional[int]
+    name: str
+    by_line: str
+    item_id: str
+    list_name: str
+    price_amazon_minor: Optional[int]
+    price_used_new_minor: Optional[int]
+    currency: Optional[str]
@@ -3,33 +3,128 @@ Contains functions for getting Amazon wish lists
 """
 
 import amazon
+import contextlib
 import db
+import gzip
+import hashlib
+from itemrecord import ItemRecord
 import json
+import metrics
+import os
 import pathlib
-import traceback
-from typing import Any, Dict, List
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# number of lists fetched at once, each with its own browser
+MAX_WORKERS = 4
+# archive of every saved list in ~/bookshelf/lists, one JSON item per line, gzip compressed if the name ends in .gz
+LIST_DUMP = 'listdump.jsonl.gz'
+# the old dump, a single JSON array rewritten on every save, converted by convert_list_dump
+LEGACY_LIST_DUMP = 'listdump.json'
+LIST_DIR = pathlib.Path.home().joinpath('bookshelf', 'lists')
+# skip lists and items whose html hasn't changed since the last pull, see pipeline.PullPipeline.dispatch_list
+PAGE_CACHE = True
+# held by whichever process is pulling, so the GUI and the scheduler never pull at the same time
+PULL_LOCK = pathlib.Path.home().joinpath('bookshelf', 'pull.lock')
+
+
+class PullLocked(RuntimeError):
+    """
+    Another pull, in this process or another one, holds the pull lock.
+    """
+
+
+@contextlib.contextmanager
+def pull_lock(path: pathlib.Path = PULL_LOCK) -> Iterator[None]:
+    """
+    Hold the pull lock for the with block. The lock is an OS file lock, so it is released if the process dies.
+    :param path: lock file
+    :raise PullLocked: if another pull holds the lock
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open(mode='a+') as f:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise PullLocked('Another pull is already running')
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def open_dump(path: pathlib.Path, mode: str) -> Any:
+    """
+    Open a list dump as text, through gzip if its name ends in .gz.
+    :param path: path of the dump
+    :param mode: 'r' or 'a'
+    :return: file object
+    """
+    if path.suffix == '.gz':
+        return gzip.open(path, mode=mode + 't', encoding='utf-8')
+    return path.open(mode=mode, encoding='utf-8')
+
+
+def append_to_dump(items: List[ItemRecord], file_name: str = LIST_DUMP) -> None:
+    """
+    Append items to a list dump with a single write. Appending to a gzip dump adds a gzip member, which is read
+    back as part of the same stream.
+    :param items: list of ItemRecord
+    :param file_name: name of the dump in ~/bookshelf/lists
+    """
+    LIST_DIR.mkdir(parents=True, exist_ok=True)
+    lines = ''.join(json.dumps(it._asdict()) + '\n' for it in items)
+    with open_dump(LIST_DIR.joinpath(file_name), 'a') as f:
+        f.write(lines)
 
 
 def save_list_to_file(items: Any, name: str = None) -> None:
     print('Saving list: ', name)
-    save_items = amazon.build_items_list(items, name)
-    list_dir_path = pathlib.Path.home().joinpath('bookshelf', 'lists')
-    if not list_dir_path.exists():
-        list_dir_path.mkdir()
-
-    path = pathlib.Path.home().joinpath('bookshelf', 'lists', 'listdump.json')
-    if path.exists():
-        with path.open(mode='r') as f:
-            existing_items = json.load(f)
-        save_items = existing_items + save_items
-    with path.open(mode='w') as f:
-        json.dump(save_items, f)
+    append_to_dump(amazon.build_items_list(items, name))
 
 
-def save_list(items: Any, name: str = None) -> None:
+def save_list(items: Any, name: str = None) -> int:
     print('Saving list to database: ', name)
     save_items = amazon.build_items_list(items, name)
     db.load_data(save_items)
+    return len(save_items)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def hash_page(html_source: str) -> Tuple[List[str], List[str], str]:
+    """
+    Split a list page into item fragments and hash them for the page cache. The page hash is taken over the hashes
+    of the item fragments, so changes to the rest of the page don't count.
+    :param html_source: html of the list
+    :return: tuple of the item fragments, their hashes and the page hash
+    """
+    fragments = list(amazon.iter_item_fragments(html_source))
+    hashes = [content_hash(f) for f in fragments]
+    return fragments, hashes, content_hash(''.join(hashes))
+
+
+def cached_hits(hashes: List[str], cached_fragments: Dict[str, str]) -> Dict[str, str]:
+    """
+    The fragments of a page that were on it at the last pull, which don't need parsing again.
+    :param hashes: hashes of the page's item fragments
+    :param cached_fragments: dict of fragment hash to item_external_id from db.get_page_cache
+    :return: dict of fragment hash to item_external_id of the fragments found in the cache
+    """
+    return {h: cached_fragments[h] for h in hashes if h in cached_fragments}
 
 
 def get_lists_from_file(file_name: str) -> List:
@@ -69,25 +164,115 @@ def add_list_to_file(url: str, name: str) -> None:
             json.dump(new_list_urls, f)
 
 
-def download_all_lists():
-    # open file and load contents
-    list_urls = get_lists_from_file('list_urls.json')
-    for url in list_urls:
-        print('Downloading list: ', url['name'])
+def fetch_list(url: Dict[str, str], pool: amazon.BrowserPool, session: Any, timeout: float, backend: str) -> str:
+    print('Downloading list: ', url['name'])
+    with metrics.span('fetch', list=url['name']):
+        return amazon.get_list_html(url['url'], name=url['name'], pool=pool, timeout=timeout, backend=backend,
+                                    session=session)
+
+
+def download_all_lists(max_workers: int = MAX_WORKERS, timeout: float = amazon.LIST_TIMEOUT,
+                       backend: str = amazon.FETCH_BACKEND,
+                       on_progress: Optional[Callable[[str, int, Optional[str], int, int], None]] = None,
+                       cancel: Optional[threading.Event] = None, use_cache: bool = PAGE_CACHE,
+                       stats: Optional[Dict[str, int]] = None) -> Dict[str, str]:
+    """
+    Download every list in list_urls.json, see download_lists.
+    """
+    return download_lists(get_lists_from_file('list_urls.json'), max_workers, timeout, backend, on_progress, cancel,
+                          use_cache, stats)
+
+
+def download_lists(list_urls: List[Dict[str, str]], max_workers: int = MAX_WORKERS,
+                   timeout: float = amazon.LIST_TIMEOUT, backend: str = amazon.FETCH_BACKEND,
+                   on_progress: Optional[Callable[[str, int, Optional[str], int, int], None]] = None,
+                   cancel: Optional[threading.Event] = None, use_cache: bool = PAGE_CACHE,
+                   stats: Optional[Dict[str, int]] = None, parse_workers: Optional[int] = None) -> Dict[str, str]:
+    """
+    Download lists through the pull pipeline (see pipeline.py): up to max_workers lists are fetched at once over a
+    shared http session and, for the selenium backend or fallback, a shared pool of browsers, the item fragments that
+    changed since the last pull are parsed by a pool of parse_workers processes, and the items of many lists are
+    loaded together in large transactions. The pull lock is held throughout.
+    A list that fails or times out is recorded and the remaining lists carry on.
+    :param list_urls: list of dicts of names and urls, as in list_urls.json
+    :param max_workers: maximum number of lists fetched concurrently
+    :param timeout: seconds allowed for each list page to load
+    :param backend: one of amazon.FETCH_BACKENDS
+    :param on_progress: called after each list is saved or fails, with the list name, number of items on it,
+    error message or None, number of lists finished and number of lists in the pull
+    :param cancel: set it to stop the pull, lists not yet started are skipped and lists not yet parsed are not saved
+    :param use_cache: skip unchanged lists and items, see pipeline.PullPipeline.dispatch_list
+    :param stats: if given, filled with the page cache hit counts of the pull: lists, lists_unchanged, items and
+    items_reused
+    :param parse_workers: number of parse processes, pipeline.PARSE_WORKERS if None
+    :return: dict of list name to error message for the lists that failed
+    :raise PullLocked: if another pull is running
+    """
+    import pipeline
+
+    stats = {} if stats is None else stats
+    pull = pipeline.PullPipeline(list_urls, max_workers, timeout, backend, on_progress, cancel, use_cache, stats,
+                                 pipeline.PARSE_WORKERS if parse_workers is None else parse_workers)
+    with pull_lock(), metrics.span('pull'):
+        failures = pull.run()
+    print(cache_summary(stats))
+    if metrics.enabled():
+        metrics.write_prometheus()
+    return failures
+
+
+def cache_summary(stats: Dict[str, int]) -> str:
+    """
+    :param stats: page cache hit counts filled in by download_all_lists
+    :return: the hit rates as text
+    """
+    item_rate = stats['items_reused'] / stats['items'] if stats['items'] > 0 else 0
+    return 'Page cache: {} of {} lists unchanged, {} of {} items reused ({:.0%})'.format(
+        stats['lists_unchanged'], stats['lists'], stats['items_reused'], stats['items'], item_rate)
+
+
+def load_list(file_name: str = LIST_DUMP) -> Iterator[ItemRecord]:
+    """
+    Read the items of a list dump one at a time. A dump in the old single array format is read whole.
+    A partly written last line, left by a save that was interrupted, is skipped.
+    :param file_name: name of the dump in ~/bookshelf/lists
+    :return: generator of ItemRecord in the order they were saved
+    """
+    path = LIST_DIR.joinpath(file_name)
+    if not path.exists():
+        return
+    with open_dump(path, 'r') as f:
         try:
-            save_list(amazon.get_amazon_list(url['url'], name=url['name']), url['name'])
-        except Exception as e:
-            print(e, ' in download_all_lists')
-            traceback.print_exc()
+            for line in f:
+                if line.startswith('['):
+                    # old format, the whole dump is one JSON array
+                    yield from (ItemRecord.from_dict(it) for it in json.loads(line + f.read()))
+                    return
+                try:
+                    yield ItemRecord.from_dict(json.loads(line))
+                except ValueError as e:
+                    print(e, ' in load_list')
+        except EOFError as e:
+            print(e, ' in load_list')
 
 
-def load_list(file_name: str) -> List[Dict[str, str]]:
-    path = pathlib.Path.home().joinpath('bookshelf', 'lists', file_name)
+def convert_list_dump(file_name: str = LEGACY_LIST_DUMP, target: str = LIST_DUMP) -> int:
+    """
+    Move the items of an old listdump.json into the append-only dump, then rename the old file to
+    listdump.json.converted so it isn't converted twice.
+    :param file_name: name of the old dump in ~/bookshelf/lists
+    :param target: name of the dump the items are appended to
+    :return: number of items converted
+    """
+    path = LIST_DIR.joinpath(file_name)
     if not path.exists():
-        return []
-    with path.open(mode='r') as f:
-        return json.loads(f.read())
+        return 0
+    items = list(load_list(file_name))
+    append_to_dump(items, target)
+    path.rename(path.with_name(path.name + '.converted'))
+    print('Converted', len(items), 'items from', file_name, 'to', target)
+    return len(items)
 
 
 if __name__ == '__main__':
-    pass
+    convert_list_dump()
@@ -1,36 +1,31 @@
-import analyze
 import PySimpleGUI as sg
 import db
-import listutils
 import logging
+import tablemodel
+import threading
 from typing import Any, Dict, List
 
 
-def wrap_text(text: str, n=60) -> str:
-    return '\n'.join(list(text[i: i+n] for i in range(0, len(text), n)))
-
-
 def make_headers_and_rows(items: List) -> (List, List):
-    headers = ['Title', 'Author', 'Price', 'New & Used', 'Rating', 'Reviews', 'List', 'Updated', 'Item ID',
-               'Ext. Item ID']
-    row_data = [[wrap_text(it['name']), it['by_line'], it['price_amazon'], it['price_used_new'], str(it['rating']),
-                 str(it['num_reviews']), it['list_name'], it['update_date'], it['item_id'], it['item_external_id']]
-                for it in items]
-    return headers, row_data
+    row_data = [tablemodel.render_row(it) for it in items]
+    return tablemodel.HEADERS, row_data
 
 
-def make_main_layout(items: List) -> List:
-    headers, row_data = make_headers_and_rows(items)
+def make_main_layout(model: tablemodel.TableModel) -> List:
+    headers = tablemodel.HEADERS
+    row_data = model.page_rows()
 
-    menu_def = [['Lists', ['Pull Lists', 'Add List', 'View Lists']],
-                ['Charts', ['Histogram - Amazon Price', 'Ratings vs Reviews']]]
+    menu_def = [['Lists', ['Pull Lists', 'Cancel Pull', 'Add List', 'View Lists']],
+                ['Charts', ['Histogram - Amazon Price', 'Ratings vs Reviews', 'Best Current Deals']]]
 
-    layout_top = [[sg.Menu(menu_def)], [sg.Text(str(len(items)) + ' Items')],
+    layout_top = [[sg.Menu(menu_def)], [sg.Text(str(model.total) + ' Items', size=(20, 1), key='-COUNT-'),
+                                        sg.Text('', size=(60, 1), key='-STATUS-')],
+                  [sg.Text('Search'), sg.Input(size=(40, 1), enable_events=True, key='-SEARCH-')],
                   [sg.Button("Sort Title"),
                   sg.Button("Sort Author"), sg.Button("Sort Amazon Price"), sg.Button("Sort Rating"),
-                   sg.Button('Sort Num Reviews')]]
-    if len(items) == 0:
-        row_data = [['', '', '', '', '', '', '', '', '', '']]
+                   sg.Button('Sort Num Reviews'),
+                   sg.Button('Prev Page'), sg.Text(model.page_label(), size=(16, 1), key='-PAGE-'),
+                   sg.Button('Next Page')]]
 
     # layout = layout_top + rows
     layout_table = [[sg.Table(values=row_data, headings=headers, max_col_width=30,
@@ -48,6 +43,75 @@ def make_main_layout(items: List) -> List:
     return layout
 
 
+def show_page(window: Any, model: tablemodel.TableModel) -> None:
+    """
+    Put the model's current page in the table.
+    :param window: the main window
+    :param model: model of the table
+    """
+    window['-TABLE-'].update(model.page_rows())
+    window['-PAGE-'].update(model.page_label())
+    window['-COUNT-'].update(str(model.total) + ' Items')
+
+
+def show_deals_window(deals: List[Dict]) -> None:
+    """
+    Show the items with the biggest price drops below their moving average.
+    :param deals: list of dicts from analyze.best_deals
+    """
+    import analyze
+
+    headers = ['Title', 'Author', 'Price', str(analyze.DEAL_WINDOW_DAYS) + ' Day Avg.', 'Drop', 'All Time Low',
+               'List']
+    rows = [[tablemodel.wrap_text(d['name']), d['by_line'], d['price_amazon'],
+             '{:.2f}'.format(d['moving_average'] / 100), '{:.0%}'.format(d['pct_drop']),
+             '{:.2f}'.format(d['all_time_low'] / 100), d['list_name']] for d in deals]
+    if len(rows) == 0:
+        rows = [['No price drops found', '', '', '', '', '', '']]
+    layout_popup = [[sg.Table(values=rows, headings=headers, max_col_width=30, auto_size_columns=True,
+                              justification='left', num_rows=15, row_height=35)],
+                    [sg.Cancel('Close')]]
+    window_popup = sg.Window('Best Current Deals', layout_popup, resizable=True)
+    window_popup.read()
+    window_popup.Close()
+
+
+def run_pull(window: Any, cancel: threading.Event) -> None:
+    """
+    Pull all lists on a background thread, posting -PULL-PROGRESS- after each list and -PULL-DONE- with the
+    failures and the page cache summary at the end to the window's event loop. Progress is not posted once the
+    pull is cancelled, since the window may be closing. The pull fails at once if the scheduler (cli.py daemon) is
+    pulling.
+    :param window: the main window
+    :param cancel: set to stop the pull
+    """
+    import listutils
+
+    def progress(name, count, error, done, total):
+        if not cancel.is_set():
+            window.write_event_value('-PULL-PROGRESS-', (name, count, error, done, total))
+
+    stats = {}
+    try:
+        failures = listutils.download_all_lists(on_progress=progress, cancel=cancel, stats=stats)
+    except Exception as e:
+        logging.exception('Pull failed')
+        failures = {'all lists': str(e)}
+    summary = listutils.cache_summary(stats) if 'lists' in stats else ''
+    if not window.was_closed():
+        window.write_event_value('-PULL-DONE-', (failures, summary))
+
+
+def make_window(model: tablemodel.TableModel) -> Any:
+    """
+    Build the main window around the first page of the table.
+    :param model: model of the table, already loaded
+    :return: the main window
+    """
+    layout = make_main_layout(model)
+    return sg.Window('Main Window', resizable=True).Layout([[sg.Column(layout, size=(1300, 700), scrollable=True)]])
+
+
 def main_window():
     """
 
@@ -60,20 +124,49 @@ def main_window():
     sort_reviews_direction = True
     logging.info('Starting GUI')
 
-    items = db.get_current_items()
-    layout = make_main_layout(items)
-
-    window = sg.Window('Main Window', resizable=True).Layout([[sg.Column(layout, size=(1300, 700), scrollable=True)]])
+    db.open_session()
+    model = tablemodel.TableModel()
+    model.reload()
+    window = make_window(model)
+    pull_thread = None
+    pull_cancel = threading.Event()
 
     while True:
         event, values = window.read()
         if event == sg.WIN_CLOSED or event == 'Cancel':
             break
         if event == 'Pull Lists':
-            listutils.download_all_lists()
-            items = db.get_current_items()
-            headers, row_data = make_headers_and_rows(items)
-            window['-TABLE-'].update(row_data)
+            if pull_thread is not None and pull_thread.is_alive():
+                window['-STATUS-'].update('A pull is already running')
+            else:
+                pull_cancel = threading.Event()
+                pull_thread = threading.Thread(target=run_pull, args=(window, pull_cancel), daemon=True)
+                pull_thread.start()
+                window['-STATUS-'].update('Pulling lists...')
+        if event == 'Cancel Pull':
+            if pull_thread is not None and pull_thread.is_alive():
+                pull_cancel.set()
+                window['-STATUS-'].update('Cancelling pull after the lists in progress...')
+        if event == '-PULL-PROGRESS-':
+            name, count, error, done, total = values[event]
+            result = 'failed: ' + error if error is not None else str(count) + ' items'
+            window['-STATUS-'].update('Pulled ' + str(done) + ' of ' + str(total) + ' lists (' + name + ' ' +
+                                      result + ')')
+            # re-read only the page on screen, rows of unchanged items come from the row cache
+            model.reload()
+            show_page(window, model)
+        if event == '-PULL-DONE-':
+            failures, summary = values[event]
+            status = 'Pull cancelled' if pull_cancel.is_set() else 'Pull finished'
+            if 'all lists' in failures:
+                status = 'Pull failed: ' + failures['all lists']
+            elif len(failures) > 0:
+                status += ', failed: ' + ', '.join(failures)
+            if summary:
+                status += '. ' + summary
+            window['-STATUS-'].update(status)
+            model.reload()
+            show_page(window, model)
         if event == 'Add List':
             # list_url = sg.popup_get_text('Add List', 'Paste URL for list from your browser')
             layout_popup = [
@@ -85,48 +178,62 @@ def main_window():
             window_popup = sg.Window('Add List', layout_popup)
             event, values = window_popup.read()
             if event == 'Submit':
+                import listutils
                 listutils.add_list_to_file(values[0], values[1])
             window_popup.Close()
         if event == 'View Lists':
+            import listutils
             lists = listutils.get_lists_from_file('list_urls.json')
             layout_popup = [[sg.Text(it['name']), sg.Text(it['url'])] for it in lists] + [[sg.Cancel()]]
             window_popup = sg.Window('View Lists', layout_popup)
             event, values = window_popup.read()
             window_popup.Close()
         if event == 'Sort Title':
-            items = sorted(items, key=lambda x: x['name'], reverse=sort_title_direction)
+            model.sort('name', descending=sort_title_direction)
             sort_title_direction = not sort_title_direction
-            headers, row_data = make_headers_and_rows(items)
-            window['-TABLE-'].update(row_data)
+            show_page(window, model)
         if event == 'Sort Author':
-            items = sorted(items, key=lambda x: x['by_line'], reverse=sort_author_direction)
+            model.sort('by_line', descending=sort_author_direction)
             sort_author_direction = not sort_author_direction
-            headers, row_data = make_headers_and_rows(items)
-            window['-TABLE-'].update(row_data)
+            show_page(window, model)
         if event == 'Sort Amazon Price':
-            items = sorted(items, key=lambda x: x['price_amazon'], reverse=sort_amazon_price_direction)
+            model.sort('price_amazon', descending=sort_amazon_price_direction)
             sort_amazon_price_direction = not sort_amazon_price_direction
-            headers, row_data = make_headers_and_rows(items)
-            window['-TABLE-'].update(row_data)
+            show_page(window, model)
         if event == 'Sort Rating':
-            items = sorted(items, key=lambda x: str(x['rating']), reverse=sort_rating_direction)
+            model.sort('rating', descending=sort_rating_direction)
             sort_rating_direction = not sort_rating_direction
-            headers, row_data = make_headers_and_rows(items)
-            window['-TABLE-'].update(row_data)
+            show_page(window, model)
         if event == 'Sort Num Reviews':
-            items = sorted(items, key=lambda x: analyze.ensure_int(x['num_reviews']), reverse=sort_reviews_direction)
+            model.sort('num_reviews', descending=sort_reviews_direction)
             sort_reviews_direction = not sort_reviews_direction
-            headers, row_data = make_headers_and_rows(items)
-            window['-TABLE-'].update(row_data)
+            show_page(window, model)
+        if event == '-SEARCH-':
+            model.set_search(values['-SEARCH-'])
+            show_page(window, model)
+        if event == 'Prev Page':
+            model.go_to(model.page - 1)
+            show_page(window, model)
+        if event == 'Next Page':
+            model.go_to(model.page + 1)
+            show_page(window, model)
         if event == 'Histogram - Amazon Price':
-            prices = [d['price_amazon'] for d in items]
-            analyze.plot_price_histogram(prices)
+            import analyze
+            columns = analyze.load_chart_columns()
+            analyze.plot_price_histogram(columns['price'])
         if event == 'Ratings vs Reviews':
-            ratings_reviews = [[d['rating'], d['num_reviews']] for d in items]
-            analyze.plot_ratings_reviews(ratings_reviews)
-
-
+            import analyze
+            columns = analyze.load_chart_columns()
+            analyze.plot_ratings_reviews(columns['rating'], columns['num_reviews'])
+        if event == 'Best Current Deals':
+            import analyze
+            show_deals_window(analyze.best_deals())
+
+    if pull_thread is not None and pull_thread.is_alive():
+        pull_cancel.set()
+        pull_thread.join()
     window.close()
+    db.close_session()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+"""
+Timings and counters for finding slow stages of pulls and queries.
+Spans time a stage, counters add up things like items, bytes, errors and retries. Each finished span is written as
+a line of JSON to METRICS_LOG, and write_prometheus writes the totals in Prometheus text format to METRICS_PROM.
+Collection is off unless enable() is called or BOOKSHELF_METRICS is set in the environment. When it is off span()
+and count() return at once, so instrumented code runs at full speed.
+"""
+
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+METRICS_DIR = pathlib.Path.home().joinpath('bookshelf', 'metrics')
+# one JSON object per finished span
+METRICS_LOG = METRICS_DIR.joinpath('metrics.jsonl')
+# totals of every span and counter, rewritten by write_prometheus
+METRICS_PROM = METRICS_DIR.joinpath('bookshelf.prom')
+# prefix of the Prometheus metric names
+PROM_PREFIX = 'bookshelf_'
+
+_enabled = False
+_lock = threading.Lock()
+_log = None
+# (name, labels) -> total
+_counters = {}
+# (name, labels) -> [count, sum of seconds, max seconds]
+_spans = {}
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(log_path: Optional[pathlib.Path] = METRICS_LOG) -> None:
+    """
+    Start collecting metrics.
+    :param log_path: file the spans are appended to as JSON lines, None to only keep totals
+    """
+    global _enabled, _log
+    with _lock:
+        if _log is not None:
+            _log.close()
+            _log = None
+        if log_path is not None:
+            log_path = pathlib.Path(log_path)
+            log_path.parent.mkdir(parents=True, exist_ok=True)
+            _log = log_path.open(mode='a', encoding='utf-8', buffering=1)
+        _enabled = True
+
+
+def disable() -> None:
+    """
+    Stop collecting metrics and close the log. The totals collected so far are kept.
+    """
+    global _enabled, _log
+    with _lock:
+        _enabled = False
+        if _log is not None:
+            _log.close()
+            _log = None
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _NullSpan:
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name: str, labels: Dict[str, Any]):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self) -> '_Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        _record(self.name, time.perf_counter() - self.start, self.labels,
+                None if exc_type is None else exc_type.__name__)
+
+
+def _record(name: str, seconds: float, labels: Dict[str, Any], error: Optional[str] = None) -> None:
+    key = _key(name, labels)
+    with _lock:
+        totals = _spans.get(key)
+        if totals is None:
+            _spans[key] = [1, seconds, seconds]
+        else:
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+        if _log is not None:
+            entry = {'time': time.time(), 'span': name, 'seconds': seconds, 'labels': labels}
+            if error is not None:
+                entry['error'] = error
+            _log.write(json.dumps(entry, default=str) + '\n')
+
+
+def span(name: str, **labels: Any) -> Any:
+    """
+    Time the with block as a stage, e.g. with metrics.span('page_load', list=name):
+    :param name: name of the stage
+    :param labels: values identifying what the stage worked on, e.g. the list
+    :return: context manager
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+
+def observe(name: str, seconds: float, **labels: Any) -> None:
+    """
+    Record a stage timed elsewhere as a span, e.g. one that ran in another process.
+    :param name: name of the stage
+    :param seconds: how long it took
+    :param labels: values identifying what the stage worked on, e.g. the list
+    """
+    if not _enabled:
+        return
+    _record(name, seconds, labels)
+
+
+def count(name: str, value: float = 1, **labels: Any) -> None:
+    """
+    Add to a counter.
+    :param name: name of the counter, e.g. 'items'
+    :param value: amount added
+    :param labels: values identifying what is counted, e.g. the list
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    :return: dict of the counter totals and the span count, total and max seconds, keyed by name and labels
+    """
+    with _lock:
+        return {'counters': dict(_counters), 'spans': {k: tuple(v) for k, v in _spans.items()}}
+
+
+def _prom_labels(labels: Tuple) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(k + '="' + v + '"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def write_prometheus(path: pathlib.Path = METRICS_PROM) -> None:
+    """
+    Write the totals in Prometheus text format, e.g. for the node exporter's textfile collector. The file is
+    replaced in one step so a scrape never sees it half written.
+    :param path: file to write
+    """
+    totals = snapshot()
+    lines = []
+    for name in sorted({k[0] for k in totals['counters']}):
+        metric = PROM_PREFIX + name + '_total'
+        lines.append('# TYPE ' + metric + ' counter')
+        for (n, labels), value in sorted(totals['counters'].items()):
+            if n == name:
+                lines.append(metric + _prom_labels(labels) + ' ' + repr(float(value)))
+    for name in sorted({k[0] for k in totals['spans']}):
+        metric = PROM_PREFIX + name + '_seconds'
+        lines.append('# TYPE ' + metric + ' summary')
+        for (n, labels), (number, seconds, longest) in sorted(totals['spans'].items()):
+            if n == name:
+                lines.append(metric + '_count' + _prom_labels(labels) + ' ' + str(number))
+                lines.append(metric + '_sum' + _prom_labels(labels) + ' ' + repr(seconds))
+        lines.append('# TYPE ' + metric + '_max gauge')
+        for (n, labels), (number, seconds, longest) in sorted(totals['spans'].items()):
+            if n == name:
+                lines.append(metric + '_max' + _prom_labels(labels) + ' ' + repr(longest))
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open(mode='w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+if os.environ.get('BOOKSHELF_METRICS'):
+    enable()
@@ -0,0 +1,309 @@
+"""
+Pulls as a pipeline of stages connected by bounded queues:
+
+    fetch threads -> html queue -> dispatcher -> parse processes -> work queue -> writer
+
+Fetch threads download lists. The dispatcher checks each page against the page cache and sends the item fragments
+that changed, in chunks, to a pool of processes that parse them on every core. The writer, on the calling thread,
+collects the parsed items of many lists and loads them in large transactions. Every queue is bounded, so a stage
+that falls behind makes the stages before it wait: memory stays bounded and a pull runs at the pace of its slowest
+stage rather than the sum of them.
+"""
+
+import amazon
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import datetime as dt
+import db
+from itemrecord import ItemRecord
+import listutils
+import metrics
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# lists fetched and waiting for the dispatcher
+HTML_QUEUE_SIZE = 4
+# parse tasks and finished lists waiting for the writer
+WORK_QUEUE_SIZE = 32
+# item fragments sent to a parse process at once
+PARSE_CHUNK_SIZE = 250
+# processes parsing item fragments, one core is left for fetching and writing. With 0 the dispatcher parses on its own
+# thread, since on a single core parse processes only add the cost of starting them and pickling the items.
+PARSE_WORKERS = (os.cpu_count() or 1) - 1
+# most items loaded in one transaction
+WRITE_BATCH_SIZE = 5000
+# seconds the writer waits for more items before loading a smaller batch
+WRITE_IDLE = 1.0
+# seconds a stage waits on a queue before checking whether the pull was stopped
+POLL_INTERVAL = 0.1
+
+
+def parse_fragments(fragments: List[Tuple[str, str]], list_name: str,
+                    update_date: str) -> Tuple[float, List[Tuple[str, ItemRecord]]]:
+    """
+    Parse item fragments into ItemRecords. Runs in the parse processes, so it is a top level function taking plain
+    values, and returns how long it took for the writer to record, since metrics are collected per process.
+    :param fragments: list of tuples of fragment hash and fragment html
+    :param list_name: the name of the Amazon list
+    :param update_date: date of the pull, given to every item
+    :return: tuple of seconds spent parsing and a list of tuples of fragment hash and ItemRecord, for the fragments
+    that hold an item
+    """
+    start = time.perf_counter()
+    hashes = []
+
+    def items():
+        for fragment_hash, fragment in fragments:
+            item = amazon.parse_fragment(fragment)
+            if item is not None:
+                hashes.append(fragment_hash)
+                yield item
+
+    parsed = list(zip(hashes, amazon.build_items_list(items(), list_name, update_date)))
+    return time.perf_counter() - start, parsed
+
+
+class PullPipeline:
+    """
+    One pull of a set of lists through the pipeline, see run.
+    """
+
+    def __init__(self, list_urls: List[Dict[str, str]], max_workers: int = listutils.MAX_WORKERS,
+                 timeout: float = amazon.LIST_TIMEOUT, backend: str = amazon.FETCH_BACKEND,
+                 on_progress: Optional[Callable[[str, int, Optional[str], int, int], None]] = None,
+                 cancel: Optional[threading.Event] = None, use_cache: bool = listutils.PAGE_CACHE,
+                 stats: Optional[Dict[str, int]] = None, parse_workers: int = PARSE_WORKERS):
+        self.list_urls = list_urls
+        self.max_workers = max(1, min(max_workers, len(list_urls)))
+        self.timeout = timeout
+        self.backend = backend
+        self.on_progress = on_progress
+        self.cancel = cancel
+        self.use_cache = use_cache
+        self.stats = {} if stats is None else stats
+        self.stats.update(lists=0, lists_unchanged=0, items=0, items_reused=0)
+        self.parse_workers = parse_workers
+        self.html_queue = queue.Queue(maxsize=HTML_QUEUE_SIZE)
+        self.work_queue = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+        self.stop = threading.Event()
+        self.failures = {}
+        self.done = 0
+        self._parser = None
+        # writer state: items waiting to be loaded, lists complete once they are, and the fragments parsed per list
+        self._batch = []
+        self._completed = []
+        self._parsed = {}
+
+    def _put(self, q: queue.Queue, message: Any) -> bool:
+        while not self.stop.is_set():
+            try:
+                q.put(message, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+    def parser(self) -> ProcessPoolExecutor:
+        # started on the first changed list, so pulls of unchanged lists don't start any processes. Spawned rather
+        # than forked, since the parent has threads and open database connections.
+        if self._parser is None:
+            self._parser = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return self._parser
+
+    def fetch(self, url: Dict[str, str], pool: amazon.BrowserPool, session: Any) -> None:
+        """
+        Fetch stage, on the fetch threads. Waits while the html queue is full.
+        """
+        try:
+            message = (url['name'], listutils.fetch_list(url, pool, session, self.timeout, self.backend), None)
+        except Exception as e:
+            print(e, ' in PullPipeline.fetch')
+            traceback.print_exc()
+            message = (url['name'], None, str(e))
+        self._put(self.html_queue, message)
+
+    def dispatch(self) -> None:
+        """
+        Dispatch stage, on its own thread. Sends the changed fragments of each fetched list to the parse processes and
+        then tells the writer the list is complete. Waits while the work queue is full.
+        """
+        try:
+            for _ in range(len(self.list_urls)):
+                message = self._get(self.html_queue)
+                if message is None:
+                    return
+                name, html_source, error = message
+                if error is None:
+                    try:
+                        self.dispatch_list(name, html_source)
+                    except Exception as e:
+                        print(e, ' in PullPipeline.dispatch')
+                        traceback.print_exc()
+                        error = str(e)
+                if error is not None:
+                    self._put(self.work_queue, ('failed', name, error))
+        finally:
+            # the dispatcher thread ends with the pull, so its read connection is closed rather than left to the session
+            db.get_session().close_reader()
+            self._put(self.work_queue, ('end',))
+
+    def dispatch_list(self, name: str, html_source: str) -> None:
+        """
+        Check a list against the page cache. If the page hash is unchanged nothing is parsed, otherwise only the
+        fragments not seen on the last pull are sent to be parsed. Either way the writer marks the items on the page
+        as seen.
+        """
+        metrics.count('bytes', len(html_source.encode('utf-8')), list=name)
+        fragments, hashes, page_hash = listutils.hash_page(html_source)
+        cached_page, cached_fragments = db.get_page_cache(name) if self.use_cache else (None, {})
+        update_date = str(dt.datetime.now())
+        if page_hash == cached_page:
+            print('List unchanged: ', name)
+            self._put(self.work_queue, ('list', name, page_hash, cached_fragments, update_date, True))
+            return
+        changed = [(h, f) for h, f in zip(hashes, fragments) if h not in cached_fragments]
+        for start in range(0, len(changed), PARSE_CHUNK_SIZE):
+            chunk = changed[start:start + PARSE_CHUNK_SIZE]
+            if self.parse_workers > 0:
+                future = self.parser().submit(parse_fragments, chunk, name, update_date)
+            else:
+                future = Future()
+                future.set_result(parse_fragments(chunk, name, update_date))
+            if not self._put(self.work_queue, ('items', name, future)):
+                return
+        hits = listutils.cached_hits(hashes, cached_fragments)
+        self._put(self.work_queue, ('list', name, page_hash, hits, update_date, False))
+
+    def fail(self, name: str, error: str) -> None:
+        if name in self.failures:
+            return
+        self.failures[name] = error
+        metrics.count('errors', list=name)
+        self._parsed.pop(name, None)
+        self._batch = [it for it in self._batch if it.list_name != name]
+        self.done += 1
+        if self.on_progress is not None:
+            self.on_progress(name, 0, error, self.done, len(self.list_urls))
+
+    def flush(self) -> None:
+        """
+        Load the batched items and save the page cache of the lists they complete, in one transaction. Each list's
+        part of it is timed as its save.
+        """
+        if len(self._batch) == 0 and len(self._completed) == 0:
+            return
+        batch, completed = self._batch, self._completed
+        self._batch, self._completed = [], []
+        batch_items = {}
+        for it in batch:
+            batch_items.setdefault(it.list_name, []).append(it)
+        completed_lists = {c[0]: c for c in completed}
+        names = list(batch_items) + [name for name in completed_lists if name not in batch_items]
+        try:
+            with metrics.span('write_batch'), db.get_session().transaction():
+                for name in names:
+                    with metrics.span('save', list=name):
+                        if name in batch_items and not db.load_data(batch_items[name]):
+                            raise RuntimeError('Could not save list ' + name)
+                        if name in completed_lists:
+                            db.save_page_cache(*completed_lists[name][:5])
+        except Exception as e:
+            print(e, ' in PullPipeline.flush')
+            traceback.print_exc()
+            for name in names:
+                self.fail(name, str(e))
+            return
+        for name, page_hash, fragments, update_date, unchanged, count, reused in completed:
+            self.stats['lists'] += 1
+            if count > 0 and reused == count:
+                self.stats['lists_unchanged'] += 1
+            self.stats['items'] += count
+            self.stats['items_reused'] += reused
+            metrics.count('items', count, list=name)
+            metrics.count('items_reused', reused, list=name)
+            self.done += 1
+            if self.on_progress is not None:
+                self.on_progress(name, count, None, self.done, len(self.list_urls))
+
+    def write(self) -> None:
+        """
+        Writer stage, on the calling thread. Loads items as they are parsed, in transactions of WRITE_BATCH_SIZE
+        items, or fewer once nothing has arrived for WRITE_IDLE seconds. Lists whose items are all loaded are reported
+        as soon as the writer catches up.
+        """
+        idle = 0.0
+        while True:
+            if self.cancel is not None and self.cancel.is_set():
+                print('Pull cancelled')
+                break
+            try:
+                message = self.work_queue.get(timeout=POLL_INTERVAL)
+                idle = 0.0
+            except queue.Empty:
+                idle += POLL_INTERVAL
+                if idle >= WRITE_IDLE:
+                    self.flush()
+                continue
+            kind, name = message[0], message[1] if len(message) > 1 else None
+            if kind == 'end':
+                break
+            if name in self.failures:
+                continue
+            if kind == 'failed':
+                self.fail(name, message[2])
+            elif kind == 'items':
+                try:
+                    seconds, parsed = message[2].result()
+                except Exception as e:
+                    print(e, ' in PullPipeline.write')
+                    self.fail(name, str(e))
+                    continue
+                metrics.observe('parse', seconds, list=name)
+                fragments = self._parsed.setdefault(name, {})
+                for fragment_hash, it in parsed:
+                    fragments[fragment_hash] = it.item_external_id
+                    self._batch.append(it)
+            elif kind == 'list':
+                page_hash, hits, update_date, unchanged = message[2:]
+                parsed = self._parsed.pop(name, {})
+                fragments = hits if unchanged else {**hits, **parsed}
+                count = len(fragments) if unchanged else len(hits) + len(parsed)
+                self._completed.append((name, page_hash, fragments, update_date, unchanged, count, len(hits)))
+            if len(self._batch) >= WRITE_BATCH_SIZE or (len(self._completed) > 0 and self.work_queue.empty()):
+                self.flush()
+        self.flush()
+
+    def run(self) -> Dict[str, str]:
+        """
+        Pull the lists.
+        :return: dict of list name to error message for the lists that failed
+        """
+        with amazon.BrowserPool(size=self.max_workers) as pool, \
+                amazon.make_http_session(self.max_workers) as session, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as fetchers:
+            for url in self.list_urls:
+                fetchers.submit(self.fetch, url, pool, session)
+            dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+            dispatcher.start()
+            try:
+                self.write()
+            finally:
+                self.stop.set()
+                fetchers.shutdown(wait=True, cancel_futures=True)
+                dispatcher.join()
+                if self._parser is not None:
+                    self._parser.shutdown(wait=True, cancel_futures=True)
+        return self.failures
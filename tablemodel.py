@@ -0,0 +1,152 @@
+"""
+Model behind the main window's results table. Items are read from the database a page at a time and each item's
+rendered row is kept until the item changes.
+"""
+
+import collections
+import db
+from itemrecord import CurrentItem
+from typing import List, Optional
+
+HEADERS = ['Title', 'Author', 'Price', 'New & Used', 'Rating', 'Reviews', 'Lists', 'Updated', 'Item ID',
+           'Ext. Item ID']
+# rows shown per page of the table
+PAGE_SIZE = 100
+# pages read ahead of the current page in the same query, so paging forward doesn't wait on the database
+PREFETCH_PAGES = 1
+# most rendered rows kept in memory
+ROW_CACHE_SIZE = 10000
+
+
+def wrap_text(text: str, n=60) -> str:
+    return '\n'.join(list(text[i: i+n] for i in range(0, len(text), n)))
+
+
+def render_row(item: CurrentItem) -> List[str]:
+    """
+    Turn an item from db.get_current_items into the cells of a table row.
+    :param item: CurrentItem
+    :return: list of cell strings in HEADERS order
+    """
+    return [wrap_text(item.name), item.by_line, item.price_amazon, item.price_used_new,
+            'N/A' if item.rating is None else str(item.rating),
+            'N/A' if item.num_reviews is None else str(item.num_reviews),
+            item.list_name, item.update_date, item.item_id, item.item_external_id]
+
+
+class RowCache:
+    """
+    Least recently used cache of rendered rows, keyed by item. A cached row is rendered again only when
+    the values of its item have changed.
+    """
+
+    def __init__(self, size: int = ROW_CACHE_SIZE):
+        self.size = size
+        self._rows = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get(self, item: CurrentItem) -> List[str]:
+        key = item.item_external_id
+        cached = self._rows.get(key)
+        # the item itself is the signature of its values
+        if cached is not None and cached[0] == item:
+            self._rows.move_to_end(key)
+            return cached[1]
+        row = render_row(item)
+        self._rows[key] = (item, row)
+        self._rows.move_to_end(key)
+        if len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+        return row
+
+
+class TableModel:
+    """
+    A sorted, paged view of the current items. Only the current page, plus PREFETCH_PAGES pages read ahead with it,
+    is held in memory.
+    """
+
+    def __init__(self, page_size: int = PAGE_SIZE, prefetch: int = PREFETCH_PAGES,
+                 cache_size: int = ROW_CACHE_SIZE):
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.rows = RowCache(cache_size)
+        self.order_by = None
+        self.descending = False
+        self.search = None
+        self.page = 0
+        self.total = 0
+        self._pages = {}
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-self.total // self.page_size))
+
+    def reload(self) -> None:
+        """
+        Forget the pages read so far and count the items again, e.g. after the database changed.
+        Rendered rows are kept and reused for items that did not change.
+        """
+        self._pages.clear()
+        self.total = db.count_current_items(self.search)
+        self.page = min(self.page, self.page_count - 1)
+
+    def sort(self, order_by: Optional[str], descending: bool = False) -> None:
+        """
+        Change the sort order and go back to the first page.
+        :param order_by: one of db.SORT_COLUMNS, or None
+        :param descending: sort from largest to smallest
+        """
+        self.order_by = order_by
+        self.descending = descending
+        self.page = 0
+        self._pages.clear()
+
+    def set_search(self, text: Optional[str]) -> None:
+        """
+        Only show items matching the search text, best matches first unless a sort is chosen, and go back to the
+        first page.
+        :param text: search text, None or empty to show every item
+        """
+        self.search = text or None
+        self.page = 0
+        self.reload()
+
+    def go_to(self, page: int) -> None:
+        self.page = max(0, min(page, self.page_count - 1))
+
+    def _fetch(self, page: int) -> None:
+        items = db.get_current_items(order_by=self.order_by, descending=self.descending,
+                                     limit=self.page_size * (self.prefetch + 1), offset=page * self.page_size,
+                                     search=self.search)
+        for n in range(self.prefetch + 1):
+            self._pages[page + n] = items[n * self.page_size:(n + 1) * self.page_size]
+        # keep only the pages around the current one
+        for p in [p for p in self._pages if not page - self.prefetch <= p <= page + self.prefetch]:
+            del self._pages[p]
+
+    def items(self, page: Optional[int] = None) -> List[CurrentItem]:
+        """
+        The items on a page, read from the database if the page isn't loaded.
+        :param page: page number from 0, the current page if None
+        :return: list of CurrentItem
+        """
+        page = self.page if page is None else page
+        if page not in self._pages:
+            self._fetch(page)
+        return self._pages[page]
+
+    def page_rows(self) -> List[List[str]]:
+        """
+        The rendered rows of the current page.
+        :return: list of rows for sg.Table
+        """
+        rows = [self.rows.get(it) for it in self.items()]
+        if len(rows) == 0:
+            rows = [[''] * len(HEADERS)]
+        return rows
+
+    def page_label(self) -> str:
+        return 'Page ' + str(self.page + 1) + ' of ' + str(self.page_count)